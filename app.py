@@ -67,10 +67,12 @@ CUSTOM_CSS = """
 """
 
 import pandas as pd
-import matplotlib.pyplot as plt
 import seaborn as sns
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import google_auth_httplib2
+import httplib2
 import os.path
 import numpy as np
 import base64
@@ -80,38 +82,62 @@ import platform
 import matplotlib.font_manager as fm
 from matplotlib import font_manager, rc
 import matplotlib as mpl
+import matplotlib.image as mpimg
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+import threading
+import tempfile
+import weakref
+import zipfile
+import time
+import random
+import hashlib
+import re
+import bisect
+import uuid
+import warnings
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from statistics import NormalDist
 
 # 한글 폰트 설정
+@st.cache_resource
+def find_korean_font():
+    """시스템 폰트 목록을 프로세스당 한 번만 검색해 (폰트 경로, 안내 메시지)를 반환합니다."""
+    # 시스템에서 사용 가능한 폰트 찾기
+    font_list = fm.findSystemFonts()
+    
+    # 선호하는 한글 폰트 목록
+    preferred_fonts = ['NanumGothic', 'Malgun Gothic', 'AppleGothic', 'Noto Sans CJK KR']
+    
+    # 설치된 폰트 중에서 선호하는 폰트 찾기
+    for font_name in preferred_fonts:
+        matching_fonts = [f for f in font_list if font_name.lower() in f.lower()]
+        if matching_fonts:
+            return matching_fonts[0], f"한글 폰트 '{font_name}' 적용 완료"
+    
+    # 시스템에 설치된 모든 한글 폰트 찾기
+    korean_fonts = [f for f in font_list if any(keyword in f.lower() for keyword in ['gothic', 'gulim', 'batang', 'dotum', 'korean'])]
+    if korean_fonts:
+        return korean_fonts[0], f"시스템 한글 폰트 적용 완료: {os.path.basename(korean_fonts[0])}"
+    
+    return None, None
+
 def set_korean_font():
     """한글 폰트를 설정하고 성공한 폰트 이름을 반환합니다."""
     try:
         # 기본 폰트 설정
-        plt.rcParams['font.family'] = 'DejaVu Sans'
-        plt.rcParams['axes.unicode_minus'] = False
-        
-        # 시스템에서 사용 가능한 폰트 찾기
-        font_list = fm.findSystemFonts()
-        
-        # 선호하는 한글 폰트 목록
-        preferred_fonts = ['NanumGothic', 'Malgun Gothic', 'AppleGothic', 'Noto Sans CJK KR']
-        
-        # 설치된 폰트 중에서 선호하는 폰트 찾기
-        for font_name in preferred_fonts:
-            matching_fonts = [f for f in font_list if font_name.lower() in f.lower()]
-            if matching_fonts:
-                font_path = matching_fonts[0]
-                font_prop = fm.FontProperties(fname=font_path)
-                plt.rcParams['font.family'] = font_prop.get_name()
-                st.success(f"한글 폰트 '{font_name}' 적용 완료")
-                return font_prop
-        
-        # 시스템에 설치된 모든 한글 폰트 찾기
-        korean_fonts = [f for f in font_list if any(keyword in f.lower() for keyword in ['gothic', 'gulim', 'batang', 'dotum', 'korean'])]
-        if korean_fonts:
-            font_path = korean_fonts[0]
+        mpl.rcParams['font.family'] = 'DejaVu Sans'
+        mpl.rcParams['axes.unicode_minus'] = False
+        
+        font_path, message = find_korean_font()
+        if font_path:
             font_prop = fm.FontProperties(fname=font_path)
-            plt.rcParams['font.family'] = font_prop.get_name()
-            st.success(f"시스템 한글 폰트 적용 완료: {os.path.basename(font_path)}")
+            mpl.rcParams['font.family'] = font_prop.get_name()
+            st.success(message)
             return font_prop
         
         st.warning("한글 폰트를 찾을 수 없어 기본 폰트를 사용합니다.")
@@ -128,11 +154,91 @@ KOREAN_FONT = set_korean_font()
 sns.set_style("whitegrid")
 sns.set_context("notebook", font_scale=1.2)
 
+# 렌더링 / 백그라운드 작업 설정
+# 차트는 pyplot 없이 호출마다 만든 Figure와 Agg 캔버스에만 그리므로, 여러 세션과 스레드가 동시에 렌더링해도 서로 간섭하지 않습니다.
+def new_figure(**kwargs):
+    """Agg 캔버스가 연결된 독립 Figure를 만듭니다. (pyplot 그림 목록에 등록되지 않으므로 닫을 필요 없음)"""
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def figure_to_base64(fig, dpi=300):
+    """Figure를 PNG로 저장해 base64 문자열로 반환합니다."""
+    buf = BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight', dpi=dpi, facecolor='white')
+    return base64.b64encode(buf.getvalue()).decode()
+
+@st.cache_resource
+def get_background_executor():
+    """차트 렌더링 등 백그라운드 작업에 사용하는 공용 스레드 풀을 반환합니다."""
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='mathdata-worker')
+
+@st.cache_resource
+def get_render_executor():
+    """한 요청 안의 서로 독립적인 차트들을 동시에 렌더링하는 스레드 풀을 반환합니다. (일괄 내보내기 작업 뒤에 줄 서지 않도록 따로 둠)"""
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='mathdata-render')
+
+@st.cache_resource
+def get_compute_executor():
+    """부트스트랩 등 수치 계산을 나눠 돌리는 스레드 풀을 반환합니다. (렌더링 풀 안에서 기다려도 교착되지 않도록 따로 둠)"""
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='mathdata-compute')
+
+class ArtifactCache:
+    """렌더링 결과(차트 이미지, 보고서 페이지)를 보관하는 스레드 안전 LRU 캐시입니다.
+
+    키에 학생 응답의 내용 지문이 들어가므로, 응답이 바뀐 학생만 캐시를 놓치고 다시 렌더링됩니다.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(value) if isinstance(value, (bytes, str)) else 0
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= len(previous) if isinstance(previous, (bytes, str)) else 0
+            self._items[key] = value
+            self.total_bytes += size
+            # 용량을 넘으면 가장 오래 쓰지 않은 항목부터 제거
+            while self.total_bytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.total_bytes -= len(evicted) if isinstance(evicted, (bytes, str)) else 0
+
+@st.cache_resource
+def get_chart_cache():
+    """모든 세션이 공유하는 차트 캐시를 반환합니다."""
+    return ArtifactCache()
+
+# 작업 스레드에서도 같은 객체를 쓰도록 스크립트 실행 시점에 한 번 가져옴
+CHART_CACHE = get_chart_cache()
+COMPUTE_EXECUTOR = get_compute_executor()
+RENDER_EXECUTOR = get_render_executor()
+
 # Google Sheets API 설정
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
 
-def get_google_sheets_service():
-    """구글 스프레드시트 서비스 객체를 생성합니다."""
+def get_sheets_credentials():
+    """구글 서비스 계정 인증 정보를 불러옵니다. 실패하면 안내 메시지를 표시하고 None을 반환합니다."""
     try:
         # Streamlit Cloud 환경에서 실행 중인 경우
         if 'GOOGLE_CREDENTIALS' in st.secrets:
@@ -160,10 +266,7 @@ def get_google_sheets_service():
                 credentials_json = f.read()
             st.success(f"{credentials_path}에서 인증 정보를 성공적으로 로드했습니다.")
         
-        credentials = service_account.Credentials.from_service_account_info(
-            json.loads(credentials_json), scopes=SCOPES)
-        service = build('sheets', 'v4', credentials=credentials)
-        return service
+        return load_service_account(credentials_json)
     except FileNotFoundError:
         st.error(f"인증 파일을 찾을 수 없습니다. 경로를 확인해주세요: {credentials_path}")
         return None
@@ -174,124 +277,1953 @@ def get_google_sheets_service():
         st.error(f"구글 스프레드시트 서비스 생성 중 오류가 발생했습니다: {str(e)}")
         return None
 
-def get_sheet_data(service, spreadsheet_id, range_name):
-    """구글 스프레드시트에서 데이터를 가져옵니다."""
+@st.cache_resource
+def load_service_account(credentials_json):
+    """인증 정보를 한 번만 만들어 재사용합니다. (발급받은 접근 토큰도 만료될 때까지 함께 재사용됨)"""
+    return service_account.Credentials.from_service_account_info(json.loads(credentials_json), scopes=SCOPES)
+
+# Sheets 연결 재사용
+SHEETS_HTTP_TIMEOUT_SECONDS = float(os.getenv('SHEETS_HTTP_TIMEOUT_SECONDS', '30'))
+SHEETS_POOL_SIZE = 8  # 인증 정보별로 보관할 유휴 서비스 객체 수
+
+def build_sheets_service(credentials, timeout=SHEETS_HTTP_TIMEOUT_SECONDS):
+    """keep-alive HTTP 연결 위에 스프레드시트 서비스 객체를 만듭니다. (화면 출력 없음)
+
+    같은 서비스 객체로 보내는 다음 요청은 열린 TCP/TLS 연결을 재사용합니다.
+    httplib2 연결은 스레드 안전하지 않으므로 한 객체는 한 번에 한 스레드만 써야 합니다.
+    """
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=timeout))
+    return build('sheets', 'v4', http=http, cache_discovery=False)
+
+class SheetsServicePool:
+    """연결이 살아 있는 서비스 객체를 빌려주고 돌려받는 풀입니다.
+
+    빌린 동안에는 그 스레드만 객체를 쓰므로 스레드 안전하고, 돌려받은 객체는 다음 요청(다른 세션의 재실행 포함)이
+    다시 써서 연결 설정 비용을 아낍니다. Streamlit은 재실행마다 새 스레드를 쓰므로 스레드 지역 저장소 대신 풀을 씁니다.
+    """
+
+    def __init__(self, timeout=SHEETS_HTTP_TIMEOUT_SECONDS, max_idle=SHEETS_POOL_SIZE):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.created = 0
+        self.reused = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, credentials):
+        """서비스 객체 하나를 빌립니다. with 블록이 끝나면 풀로 돌아갑니다.
+
+        인증 정보 객체 자체를 키로 씁니다. (같은 계정이라도 새 키를 올리면 새 객체가 되어 이전 키의 서비스는 빌려주지 않음)
+        """
+        key = credentials
+        with self._lock:
+            if key not in self._idle:
+                # 같은 계정의 이전 키로 만든 서비스는 버림
+                email = getattr(credentials, 'service_account_email', None)
+                for old in [old for old in self._idle if email and getattr(old, 'service_account_email', None) == email]:
+                    del self._idle[old]
+            idle = self._idle.get(key)
+            service = idle.pop() if idle else None
+            if service is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        if service is None:
+            service = build_sheets_service(credentials, self.timeout)
+        try:
+            yield service
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(service)  # 가장 최근에 쓴(연결이 살아 있을 가능성이 큰) 객체부터 다시 빌려줌
+
+@st.cache_resource
+def get_sheets_service_pool():
+    """프로세스 공용 Sheets 서비스 풀을 반환합니다."""
+    return SheetsServicePool()
+
+SHEETS_SERVICES = get_sheets_service_pool()
+
+def get_google_sheets_service():
+    """구글 스프레드시트 서비스 객체를 생성합니다."""
+    credentials = get_sheets_credentials()
+    if credentials is None:
+        return None
     try:
-        # 설문 문항 컬럼명 정리
-        survey_columns = {
-            '📌 학생 번호를 선택하세요.': '학번',
-            '🧑‍🎓 학생 이름을 입력하세요.': '학생 이름',
-            '🤩 오늘 수학 수업이 기대돼요. (1점: 전혀 기대되지 않아요 ~ 5점: 매우 기대돼요)': '수업 기대도',
-            '😨 오늘 수학 수업이 좀 긴장돼요. (1점: 전혀 긴장되지 않아요 ~ 5점: 매우 긴장돼요)': '긴장도',
-            '🎲 오늘 배우는 수학 내용이 재미있을 것 같아요. (1점: 전혀 재미없을 것 같아요 ~ 5점: 매우 재미있을 것 같아요)': '재미 예상도',
-            '💪 오늘 수업을 잘 해낼 자신이 있어요. (1점: 전혀 자신 없어요 ~ 5점: 매우 자신 있어요)': '자신감',
-            '🎯 지금 수업에 집중하고 있어요. (1점: 전혀 집중하지 못해요 ~ 5점: 완전히 집중하고 있어요)': '집중도',
-            '😆 지금 수업이 즐거워요. (1점: 전혀 즐겁지 않아요 ~ 5점: 매우 즐거워요)': '즐거움',
-            '🌟 이제 수학 공부에 자신감이 더 생겼어요. (1점: 전혀 그렇지 않아요 ~ 5점: 매우 그래요)': '자신감 변화',
-            '🎉 수업 후에 수학이 전보다 더 재미있어졌어요. (1점: 전혀 그렇지 않아요 ~ 5점: 매우 그래요)': '재미 변화',
-            '😌 수업 후에는 수학 시간에 전보다 덜 긴장돼요. (1점: 전혀 그렇지 않아요 ~ 5점: 매우 그래요)': '긴장도 변화',
-            '🧠 오늘 수업 내용을 잘 이해했어요. (1점: 전혀 이해하지 못했어요 ~ 5점: 매우 잘 이해했어요)': '이해도',
-            '📋 ✏️ 오늘 배운 수학 내용을 한 줄로 요약해 보세요.': '수업 요약',
-            '📋 💭 오늘 수업에서 스스로 잘한 점이나 아쉬운 점을 한 문장으로 적어 보세요.': '자기 평가',
-            # 기존 컬럼명도 매핑에 추가
-            '타임스탬프': '타임스탬프'
-        }
-        
-        # 스프레드시트 ID와 범위가 뒤바뀐 경우를 확인
-        if '!' in spreadsheet_id and not '!' in range_name:
-            # ID와 범위가 뒤바뀐 경우 교정
-            spreadsheet_id, range_name = range_name, spreadsheet_id
-            st.info("스프레드시트 ID와 범위가 교정되었습니다.")
+        return build_sheets_service(credentials)
+    except Exception as e:
+        st.error(f"구글 스프레드시트 서비스 생성 중 오류가 발생했습니다: {str(e)}")
+        return None
+
+# Sheets API 호출 제한 (프로세스 전체 공용)
+SHEETS_RATE_PER_MINUTE = 60   # 서비스 계정 하나의 분당 읽기 요청 한도에 맞춤
+SHEETS_BURST = 10             # 수업 시작처럼 몰릴 때 바로 보낼 수 있는 요청 수
+SHEETS_MAX_WAIT_SECONDS = 30
+SHEETS_MAX_RETRIES = 4
+SHEETS_RETRY_BASE_SECONDS = 1.0
+SHEETS_RETRY_MAX_SECONDS = 16.0
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """토큰 버킷 방식의 요청 속도 제한기입니다. 초당 rate개씩 토큰이 차고, 최대 capacity개까지 모입니다."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """토큰 하나를 얻을 때까지 기다립니다. timeout초 안에 얻지 못하면 False를 반환합니다."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+@st.cache_resource
+def get_sheets_rate_limiter():
+    """모든 세션과 작업 스레드가 함께 쓰는 Sheets API 속도 제한기를 반환합니다."""
+    return TokenBucket(SHEETS_RATE_PER_MINUTE / 60, SHEETS_BURST)
+
+SHEETS_RATE_LIMITER = get_sheets_rate_limiter()
+
+def is_retryable_error(error):
+    """할당량 초과(429), 서버 오류(5xx), 연결 문제처럼 다시 시도하면 성공할 수 있는 오류인지 확인합니다."""
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+def execute_request(request, max_retries=SHEETS_MAX_RETRIES):
+    """속도 제한기에서 토큰을 얻은 뒤 API 요청을 실행합니다.
+
+    다시 시도할 만한 오류이면 지수적으로 늘어나는 간격(full jitter)만큼 기다렸다가 max_retries번까지 다시 요청합니다.
+    """
+    for attempt in range(max_retries + 1):
+        if not SHEETS_RATE_LIMITER.acquire(timeout=SHEETS_MAX_WAIT_SECONDS):
+            raise RuntimeError("요청이 많아 구글 스프레드시트 조회를 잠시 미뤘습니다. 잠시 후 다시 시도해주세요.")
+        try:
+            return request.execute()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            time.sleep(random.uniform(0, min(SHEETS_RETRY_MAX_SECONDS, SHEETS_RETRY_BASE_SECONDS * 2 ** attempt)))
+
+# 설문 문항 컬럼명 정리
+SURVEY_COLUMNS = {
+    '📌 학생 번호를 선택하세요.': '학번',
+    '🧑‍🎓 학생 이름을 입력하세요.': '학생 이름',
+    '🤩 오늘 수학 수업이 기대돼요. (1점: 전혀 기대되지 않아요 ~ 5점: 매우 기대돼요)': '수업 기대도',
+    '😨 오늘 수학 수업이 좀 긴장돼요. (1점: 전혀 긴장되지 않아요 ~ 5점: 매우 긴장돼요)': '긴장도',
+    '🎲 오늘 배우는 수학 내용이 재미있을 것 같아요. (1점: 전혀 재미없을 것 같아요 ~ 5점: 매우 재미있을 것 같아요)': '재미 예상도',
+    '💪 오늘 수업을 잘 해낼 자신이 있어요. (1점: 전혀 자신 없어요 ~ 5점: 매우 자신 있어요)': '자신감',
+    '🎯 지금 수업에 집중하고 있어요. (1점: 전혀 집중하지 못해요 ~ 5점: 완전히 집중하고 있어요)': '집중도',
+    '😆 지금 수업이 즐거워요. (1점: 전혀 즐겁지 않아요 ~ 5점: 매우 즐거워요)': '즐거움',
+    '🌟 이제 수학 공부에 자신감이 더 생겼어요. (1점: 전혀 그렇지 않아요 ~ 5점: 매우 그래요)': '자신감 변화',
+    '🎉 수업 후에 수학이 전보다 더 재미있어졌어요. (1점: 전혀 그렇지 않아요 ~ 5점: 매우 그래요)': '재미 변화',
+    '😌 수업 후에는 수학 시간에 전보다 덜 긴장돼요. (1점: 전혀 그렇지 않아요 ~ 5점: 매우 그래요)': '긴장도 변화',
+    '🧠 오늘 수업 내용을 잘 이해했어요. (1점: 전혀 이해하지 못했어요 ~ 5점: 매우 잘 이해했어요)': '이해도',
+    '📋 ✏️ 오늘 배운 수학 내용을 한 줄로 요약해 보세요.': '수업 요약',
+    '📋 💭 오늘 수업에서 스스로 잘한 점이나 아쉬운 점을 한 문장으로 적어 보세요.': '자기 평가',
+    # 기존 컬럼명도 매핑에 추가
+    '타임스탬프': '타임스탬프'
+}
+
+# 숫자형 설문 문항
+NUMERIC_COLUMNS = ['수업 기대도', '긴장도', '재미 예상도', '자신감', '집중도', 
+                   '즐거움', '자신감 변화', '재미 변화', '긴장도 변화', '이해도']
+
+def quote_sheet_name(sheet_name):
+    """영문자·숫자·한글 외의 문자가 있는 시트 이름을 작은따옴표로 감쌉니다. (2025/03/11 -> '2025/03/11', 안의 ' 는 '' 로)"""
+    if sheet_name.isalnum():
+        return sheet_name
+    return "'" + sheet_name.replace("'", "''") + "'"
+
+def normalize_sheet_range(spreadsheet_id, range_name):
+    """뒤바뀐 ID/범위를 교정하고 특수 문자가 있는 시트 이름을 작은따옴표로 감쌉니다.
+
+    (스프레드시트 ID, 범위, ID와 범위를 교정했는지 여부)를 반환합니다.
+    """
+    swapped = False
+    
+    # 스프레드시트 ID와 범위가 뒤바뀐 경우를 확인
+    if '!' in spreadsheet_id and not '!' in range_name:
+        # ID와 범위가 뒤바뀐 경우 교정
+        spreadsheet_id, range_name = range_name, spreadsheet_id
+        swapped = True
+    
+    # 시트 이름에 특수 문자가 있는 경우 작은따옴표로 감싸기
+    if '!' in range_name:
+        sheet_name, cell_range = range_name.rsplit('!', 1)
         
-        # 시트 이름에 특수 문자가 있는 경우 작은따옴표로 감싸기
-        if '!' in range_name:
-            sheet_name, cell_range = range_name.split('!', 1)
-            
-            # 작은따옴표 제거 (이미 있는 경우)
-            if sheet_name.startswith("'") and sheet_name.endswith("'"):
-                sheet_name = sheet_name[1:-1]
+        # 작은따옴표 제거 (이미 있는 경우, 이스케이프된 '' 도 원래대로)
+        if len(sheet_name) >= 2 and sheet_name.startswith("'") and sheet_name.endswith("'"):
+            sheet_name = sheet_name[1:-1].replace("''", "'")
             
-            # 시트 이름에 특수문자가 있으면 작은따옴표로 감싸기
-            if ('.' in sheet_name or ' ' in sheet_name or '-' in sheet_name):
-                sheet_name = f"'{sheet_name}'"
-                
-            # 최종 범위 설정
-            range_name = f"{sheet_name}!{cell_range}"
-            
-            # 디버깅 정보 표시
-            st.info(f"조회할 범위: {range_name}")
+        # 최종 범위 설정
+        range_name = f"{quote_sheet_name(sheet_name)}!{cell_range}"
+    
+    return spreadsheet_id, range_name, swapped
+
+def make_dataset_key(spreadsheet_id, range_name):
+    """공유 캐시, 폴러, 집계 저장소가 함께 쓰는 (스프레드시트 ID, 범위) 키를 만듭니다. 입력 방식이 달라도 같은 시트면 같은 키입니다."""
+    return normalize_sheet_range(spreadsheet_id.strip(), range_name.strip())[:2]
+
+def values_to_frame(values):
+    """스프레드시트 값(첫 행은 헤더)을 설문 컬럼명이 정리된 데이터프레임으로 변환합니다."""
+    # 헤더 행 가져오기
+    headers = values[0]
+    
+    # 실제 데이터 행 가져오기
+    data = values[1:]
+    
+    # 데이터프레임 생성
+    df = pd.DataFrame(data)
+    
+    # 컬럼 수가 맞지 않는 경우 처리
+    if len(headers) > len(df.columns):
+        # 부족한 컬럼 추가
+        for i in range(len(df.columns), len(headers)):
+            df[i] = None
+    elif len(headers) < len(df.columns):
+        # 초과 컬럼 제거
+        df = df.iloc[:, :len(headers)]
+    
+    # 컬럼명 설정
+    df.columns = headers
+    
+    # 컬럼명 매핑 (매핑되지 않은 컬럼은 원래 이름 유지)
+    df = df.rename(columns={col: SURVEY_COLUMNS.get(col, col) for col in df.columns})
+    
+    # 숫자형 데이터 변환
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    
+    return df
+
+def fetch_sheet_frame(service, spreadsheet_id, range_name):
+    """화면 출력 없이 데이터를 가져옵니다. 백그라운드 스레드용이며 오류는 예외로 전달합니다."""
+    spreadsheet_id, range_name, _ = normalize_sheet_range(spreadsheet_id, range_name)
+    result = execute_request(service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_name))
+    values = result.get('values', [])
+    return values_to_frame(values) if values else None
+
+def show_fetch_notices(spreadsheet_id, range_name):
+    """조회 전에 범위 교정 여부와 실제 조회할 범위를 안내합니다. (스크립트 스레드에서만 호출)"""
+    _, normalized_range, swapped = normalize_sheet_range(spreadsheet_id, range_name)
+    if swapped:
+        st.info("스프레드시트 ID와 범위가 교정되었습니다.")
+    if '!' in normalized_range:
+        st.info(f"조회할 범위: {normalized_range}")
+
+def show_fetch_error(error):
+    """조회 실패를 안내합니다. 조회 자체는 화면 출력 없이 작업 스레드에서도 돌 수 있도록, 오류 표시는 호출한 세션이 합니다."""
+    st.error(f"API 요청 중 오류 발생: {str(error)}")
+    st.info("시트 이름에 마침표(.)나 특수 문자가 포함된 경우, 일반적으로 Google Sheets API에서는 작은따옴표(')로 감싸야 합니다.")
+    st.info("예시: '2025.03.29.'!A1:O2 대신 Sheet1!A1:O2와 같은 단순한 시트 이름을 사용해보세요.")
+
+# 공유 데이터셋 캐시
+DATASET_TTL_SECONDS = 60
+STALE_RETRY_SECONDS = 30  # 조회에 실패한 뒤 이 시간 동안은 다시 조회하지 않고 마지막 데이터를 씀
+DATASET_IDLE_SECONDS = 2 * 60 * 60  # 이 시간 동안 아무도 읽지 않은 데이터셋은 캐시에서 내림
+DATASET_MAX_ENTRIES = 32            # 이보다 많으면 가장 오래 쓰지 않은 데이터셋부터 내림
+
+class DatasetEntry:
+    """공유 캐시에 보관되는 데이터프레임과 그 버전 정보입니다."""
+
+    def __init__(self, df, version, fetched_at, row_hashes=None):
+        self.df = df
+        self.version = version
+        self.row_hashes = row_hashes  # 행별 내용 해시 (집계 저장소가 수정된 행을 찾는 데 사용)
+        self.fetched_at = fetched_at
+        self.last_access = fetched_at
+        self.failed_at = None  # 마지막으로 다시 조회에 실패한 시각 (오래된 데이터를 쓰는 중)
+        self._fingerprints = None
+
+    def age(self):
+        """데이터를 가져온 뒤 지난 시간(초)을 반환합니다."""
+        return time.time() - self.fetched_at
+
+    def student_fingerprints(self):
+        """학생별 응답 지문을 한 번만 계산해 보관합니다."""
+        if self._fingerprints is None:
+            self._fingerprints = student_fingerprints(self.df)
+        return self._fingerprints
+
+class SharedDatasetCache:
+    """모든 세션이 공유하는 (스프레드시트 ID, 범위)별 데이터프레임 캐시입니다.
+
+    내용이 바뀐 경우에만 버전(내용 지문)이 바뀌므로, 버전을 키로 쓰는 다른 캐시는 그대로 재사용됩니다.
+    새 데이터를 넣을 때 idle_seconds초 넘게 읽지 않은 항목과, max_entries를 넘는 가장 오래 쓰지 않은 항목을 내리고
+    등록된 리스너에게 내린 키를 알립니다 (키별로 따로 보관하는 집계도 함께 정리하도록).
+    """
+
+    def __init__(self, idle_seconds=DATASET_IDLE_SECONDS, max_entries=DATASET_MAX_ENTRIES):
+        self.idle_seconds = idle_seconds
+        self.max_entries = max_entries
+        self._entries = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_eviction_listener(self, callback):
+        """항목을 내릴 때 callback(key)를 호출하게 합니다."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, df):
+        row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        version = _fingerprint_rows(_header_bytes(df), row_hashes)
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None and previous.version == version:
+                # 내용이 같으면 기존 데이터프레임을 유지해 참조하는 쪽의 캐시를 살림
+                previous.fetched_at = time.time()
+                previous.failed_at = None
+                return previous
+            entry = DatasetEntry(df, version, time.time(), row_hashes)
+            if previous is not None:
+                # 폴러가 넣은 새 버전이 사용 시각을 갱신하지 않도록 이전 사용 시각을 이어받음
+                entry.last_access = previous.last_access
+            self._entries[key] = entry
+            evicted = self._evict(keep=key)
+            listeners = list(self._listeners)
+        for evicted_key in evicted:
+            for callback in listeners:
+                callback(evicted_key)
+        return entry
+
+    def _evict(self, keep):
+        """오래 쓰지 않은 항목을 내리고 내린 키 목록을 반환합니다. (잠금을 잡은 상태에서 호출)"""
+        now = time.time()
+        evicted = [key for key, entry in self._entries.items()
+                   if key != keep and now - entry.last_access > self.idle_seconds]
+        for key in evicted:
+            del self._entries[key]
+        if len(self._entries) > self.max_entries:
+            by_access = sorted((entry.last_access, key) for key, entry in self._entries.items() if key != keep)
+            for _, key in by_access[:len(self._entries) - self.max_entries]:
+                del self._entries[key]
+                evicted.append(key)
+        return evicted
+
+@st.cache_resource
+def get_dataset_cache():
+    """모든 세션이 공유하는 데이터셋 캐시를 반환합니다."""
+    return SharedDatasetCache()
+
+class _LeaderInterrupted(Exception):
+    """SingleFlight에서 먼저 실행하던 쪽이 Exception이 아닌 이유(스크립트 중단 등)로 멈췄음을 기다리던 호출에 알립니다."""
+
+class SingleFlight:
+    """같은 키의 작업이 이미 진행 중이면 새로 실행하지 않고 그 결과를 함께 기다립니다."""
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """key에 대한 fn을 한 번만 실행하고, 동시에 들어온 호출은 같은 결과(또는 예외)를 받습니다.
+
+        먼저 실행한 쪽의 스크립트 실행이 중단되면(Streamlit의 rerun/stop), 그 중단은 넘기지 않고
+        기다리던 호출 중 하나가 이어받아 직접 실행합니다.
+        """
+        while True:
+            with self._lock:
+                future = self._inflight.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self._inflight[key] = future
+            if not leader:
+                try:
+                    return future.result()
+                except _LeaderInterrupted:
+                    continue
+            try:
+                result = fn()
+            except BaseException as e:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                future.set_exception(e if isinstance(e, Exception) else _LeaderInterrupted())
+                raise
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_result(result)
+            return result
+
+@st.cache_resource
+def get_fetch_single_flight():
+    """(스프레드시트 ID, 범위)별 조회를 하나로 합치는 프로세스 공용 객체를 반환합니다."""
+    return SingleFlight()
+
+DATASET_CACHE = get_dataset_cache()
+FETCH_SINGLE_FLIGHT = get_fetch_single_flight()
+
+# 사전 집계 저장소 (문항별 / 세션별 / 학생별)
+SESSION_DATE_PATTERN = r'(\d{4})\s*[.\-/]\s*(\d{1,2})\s*[.\-/]\s*(\d{1,2})'
+
+def sheet_title(range_name):
+    """범위에서 시트 이름을 꺼냅니다. ('2025.03.10'!A1:O100 -> 2025.03.10, 시트 이름이 없으면 범위 그대로)"""
+    if '!' not in range_name:
+        return range_name
+    sheet_name = range_name.rsplit('!', 1)[0]
+    if len(sheet_name) >= 2 and sheet_name[0] == sheet_name[-1] == "'":
+        sheet_name = sheet_name[1:-1].replace("''", "'")
+    return sheet_name
+
+def session_name_from_range(range_name):
+    """범위의 시트 이름을 세션 이름으로 씁니다. 시트 이름이 날짜이면 YYYY-MM-DD 형식으로 바꿉니다."""
+    sheet_name = sheet_title(range_name)
+    parts = pd.Series([sheet_name]).str.extract(SESSION_DATE_PATTERN).iloc[0]
+    if parts.notna().all():
+        return f"{parts[0]}-{int(parts[1]):02d}-{int(parts[2]):02d}"
+    return sheet_name
+
+def session_labels(df, default_session):
+    """각 행이 속한 수업 세션(날짜)을 구합니다. 타임스탬프에서 날짜를 읽을 수 없으면 default_session을 씁니다."""
+    if '타임스탬프' not in df.columns:
+        return pd.Series(default_session, index=df.index)
+    parts = df['타임스탬프'].astype(str).str.extract(SESSION_DATE_PATTERN)
+    labels = parts[0] + '-' + parts[1].str.zfill(2) + '-' + parts[2].str.zfill(2)
+    return labels.fillna(default_session)
+
+class MomentAccumulator:
+    """문항 쌍별 응답 수, 평균, 제곱편차합, 공적률(co-moment)을 Welford 방식으로 누적합니다.
+
+    결측값(NaN)은 건너뛰며, 모든 통계는 두 문항에 모두 응답한 행(pairwise-complete) 기준입니다.
+    대각 성분이 문항별 응답 수·평균·분산이 되고, 상관행렬은 pandas의 DataFrame.corr()와 같은 정의를 따릅니다.
+
+    행 묶음(chunk)마다 두 번 통과(two-pass)로 통계를 구한 뒤 Chan 등의 병합 공식으로 합치므로,
+    행이 아주 많아도 수치적으로 안정적이고 메모리는 응답 수와 무관하게 O(문항²)입니다.
+    누적기끼리도 merge로 합칠 수 있어 청크, 시트, 작업 프로세스별 부분 결과를 나중에 결합할 수 있습니다.
+    """
+
+    chunk_rows = 50_000
+
+    def __init__(self, n_items):
+        shape = (n_items, n_items)
+        self.pair_counts = np.zeros(shape)  # [i, j]: 두 문항에 모두 응답한 행 수
+        self.pair_means = np.zeros(shape)   # [i, j]: 그 행들에서 문항 i의 평균
+        self.pair_m2 = np.zeros(shape)      # [i, j]: 그 행들에서 문항 i의 제곱편차합
+        self.comoment = np.zeros(shape)     # [i, j]: 그 행들에서 문항 i, j의 공적률
+
+    @property
+    def count(self):
+        """문항별 응답 수 중 가장 큰 값입니다 (무응답이 없으면 누적한 행 수)."""
+        return int(np.diag(self.pair_counts).max()) if len(self.pair_counts) else 0
+
+    def _merge_stats(self, counts, means, m2, comoment):
+        total = self.pair_counts + counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, counts / total, 0.0)
+            cross_weight = np.where(total > 0, self.pair_counts * counts / total, 0.0)
+        delta = np.where(counts > 0, means - self.pair_means, 0.0)
+        self.comoment += comoment + delta * delta.T * cross_weight
+        self.pair_m2 += m2 + delta ** 2 * cross_weight
+        self.pair_means += delta * weight
+        self.pair_counts = total
+
+    def update(self, X):
+        """(행, 문항) 행렬의 행들을 chunk_rows 단위로 누적값에 더합니다. NaN은 무응답으로 건너뜁니다."""
+        for start in range(0, len(X), self.chunk_rows):
+            chunk = X[start:start + self.chunk_rows]
+            answered = ~np.isnan(chunk)
+            mask = answered.astype(float)
+
+            # 문항별 평균만큼 옮겨서 계산해 자릿수 손실을 막음
+            answered_counts = answered.sum(axis=0)
+            shift = np.where(answered, chunk, 0.0).sum(axis=0) / np.maximum(answered_counts, 1)
+            centered = np.where(answered, chunk - shift, 0.0)
+
+            counts = mask.T @ mask
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = np.where(counts > 0, (centered.T @ mask) / counts, 0.0)
+            m2 = (centered ** 2).T @ mask - counts * means ** 2
+            comoment = centered.T @ centered - counts * means * means.T
+            self._merge_stats(counts, means + shift[:, None], m2, comoment)
+
+    def merge(self, other):
+        """다른 누적기의 결과를 합칩니다."""
+        self._merge_stats(other.pair_counts, other.pair_means, other.pair_m2, other.comoment)
+        return self
+
+    @classmethod
+    def combine(cls, accumulators, n_items):
+        """여러 부분 누적기를 하나로 합친 새 누적기를 반환합니다."""
+        merged = cls(n_items)
+        for accumulator in accumulators:
+            merged.merge(accumulator)
+        return merged
+
+    def counts(self):
+        """문항별 응답 수를 반환합니다."""
+        return np.diag(self.pair_counts).astype(int)
+
+    def mean(self):
+        counts = np.diag(self.pair_counts)
+        return np.where(counts > 0, np.diag(self.pair_means), np.nan)
+
+    def cov(self, ddof=1):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.pair_counts > ddof, self.comoment / (self.pair_counts - ddof), np.nan)
+
+    def std(self, ddof=1):
+        return np.sqrt(np.clip(np.diag(self.cov(ddof)), 0, None))
+
+    def corr(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = self.comoment / np.sqrt(np.clip(self.pair_m2 * self.pair_m2.T, 0, None))
+        return np.where(self.pair_counts > 1, np.clip(corr, -1.0, 1.0), np.nan)
+
+def item_matrix(df, items=NUMERIC_COLUMNS, missing_as_zero=False):
+    """설문 문항을 (행, 문항) 실수 행렬로 꺼냅니다. 무응답은 NaN이며, missing_as_zero이면 0점으로 바꿉니다."""
+    X = df[items].to_numpy(dtype=float)
+    if missing_as_zero:
+        X = np.nan_to_num(X, nan=0.0)
+    return X
+
+LIKERT_SCORES = [1, 2, 3, 4, 5]
+
+def likert_counts(X, n_scores=len(LIKERT_SCORES)):
+    """(행, 문항) 점수 행렬에서 문항별 1~n_scores점 응답 수를 bincount 한 번으로 셉니다.
+
+    무응답(NaN)이나 범위를 벗어난 값은 마지막 여분 칸으로 모았다가 버립니다. (문항, 점수) 정수 행렬을 반환합니다.
+    """
+    n_items = X.shape[1]
+    overflow = n_items * n_scores
+    valid = (X >= 1) & (X <= n_scores)  # NaN 비교는 항상 False
+    codes = np.where(valid, np.nan_to_num(X, nan=1.0).astype(np.int64) - 1 + n_scores * np.arange(n_items), overflow)
+    return np.bincount(codes.ravel(), minlength=overflow + 1)[:overflow].reshape(n_items, n_scores)
+
+BOOTSTRAP_RESAMPLES = 10_000
+BOOTSTRAP_SEED = 20240301
+BOOTSTRAP_CHUNK = 2_000
+BOOTSTRAP_CHUNK_BYTES = 16 * 1024 * 1024  # 청크 하나가 쓰는 임시 메모리 상한 (행 수가 많으면 청크를 줄임)
+BOOTSTRAP_MAX_ROWS = 2_000  # 이보다 행이 많으면 부트스트랩 대신 정규 근사 신뢰구간을 씀 (평균의 분포가 충분히 정규에 가까움)
+
+def bootstrap_mean_ci(X, n_resamples=BOOTSTRAP_RESAMPLES, confidence=0.95, seed=BOOTSTRAP_SEED,
+                      chunk_size=BOOTSTRAP_CHUNK, executor=None):
+    """문항별 평균의 부트스트랩 백분위 신뢰구간을 모든 문항에 대해 한 번에 구합니다.
+
+    재표집마다 행 선택 횟수를 (재표집, 행) 가중치 행렬로 만들고, 가중치 행렬 @ 점수 행렬로 모든 문항의 평균을 계산합니다.
+    무응답(NaN)은 재표집된 행 안에서 건너뜁니다. 청크 크기는 chunk_size와 메모리 상한(BOOTSTRAP_CHUNK_BYTES) 중
+    작은 쪽으로 정하며, seed와 데이터가 같으면 병렬 여부와 관계없이 결과가 같습니다.
+    executor가 주어지면 청크를 나눠 병렬로 계산합니다. (하한, 상한) 배열을 반환합니다.
+    """
+    n_rows, n_items = X.shape
+    if n_rows == 0 or n_resamples <= 0:
+        return np.full(n_items, np.nan), np.full(n_items, np.nan)
+    # (재표집, 행) 크기의 임시 배열(선택 행 번호, 밀린 번호, 횟수, 가중치)이 8바이트씩 4개
+    chunk_size = max(1, min(chunk_size, BOOTSTRAP_CHUNK_BYTES // (32 * n_rows)))
+    answered = ~np.isnan(X)
+    scores = np.where(answered, X, 0.0)
+    answered = answered.astype(float)
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    def resample_means(seed_seq, size):
+        rng = np.random.default_rng(seed_seq)
+        picks = rng.integers(0, n_rows, size=(size, n_rows))
+        # 재표집별 행 선택 횟수: 재표집 번호만큼 밀어서 bincount 한 번으로 셈
+        offsets = (np.arange(size) * n_rows)[:, None]
+        weights = np.bincount((picks + offsets).ravel(), minlength=size * n_rows).reshape(size, n_rows).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (weights @ scores) / (weights @ answered)
+
+    if executor is not None and len(sizes) > 1:
+        means = np.vstack(list(executor.map(resample_means, seeds, sizes)))
+    else:
+        means = np.vstack([resample_means(seed_seq, size) for seed_seq, size in zip(seeds, sizes)])
+    alpha = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # 응답이 없는 문항은 NaN
+        lower, upper = np.nanpercentile(means, [alpha, 100 - alpha], axis=0)
+    return lower, upper
+
+def items_mean_ci(df, means, stds, counts, n_resamples=BOOTSTRAP_RESAMPLES, missing_as_zero=False, confidence=0.95):
+    """문항별 평균의 신뢰구간을 (하한, 상한, 설명)으로 반환합니다.
+
+    행이 BOOTSTRAP_MAX_ROWS 이하이면 부트스트랩, 그보다 많으면 평균 ± z·표준편차/√n 정규 근사를 씁니다.
+    """
+    if len(df) <= BOOTSTRAP_MAX_ROWS:
+        lower, upper = bootstrap_mean_ci(item_matrix(df, NUMERIC_COLUMNS, missing_as_zero), n_resamples,
+                                         confidence, executor=COMPUTE_EXECUTOR)
+        return lower, upper, f'{confidence:.0%} 부트스트랩 신뢰구간, {n_resamples:,}회'
+    means = np.asarray(means, dtype=float)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        margin = z * np.asarray(stds, dtype=float) / np.sqrt(np.asarray(counts, dtype=float))
+    return means - margin, means + margin, f'{confidence:.0%} 신뢰구간 (정규 근사)'
+
+def _sq_distances(X, centroids):
+    """(행, 중심) 제곱 거리 행렬을 ||x||² - 2x·c + ||c||²로 한 번에 계산합니다."""
+    d2 = (X ** 2).sum(axis=1)[:, None] - 2 * X @ centroids.T + (centroids ** 2).sum(axis=1)
+    return np.maximum(d2, 0.0)
+
+def _cluster_sums(X, labels, k):
+    """군집별 좌표 합과 크기를 bincount로 구합니다."""
+    n_dims = X.shape[1]
+    codes = (labels[:, None] * n_dims + np.arange(n_dims)).ravel()
+    sums = np.bincount(codes, weights=X.ravel(), minlength=k * n_dims).reshape(k, n_dims)
+    return sums, np.bincount(labels, minlength=k)
+
+def kmeans(X, k, seed=BOOTSTRAP_SEED, n_init=4, max_iter=100, tol=1e-6, batch_size=None):
+    """NumPy만으로 k-means를 수행합니다. k-means++로 시작하고, n_init번 중 관성이 가장 작은 결과를 고릅니다.
+
+    batch_size를 주고 행이 그보다 많으면 mini-batch k-means(Sculley)로 중심을 갱신해 학교 전체 규모에서도 가볍게 돕니다.
+    (중심 행렬, 행별 군집 번호, 관성)을 반환합니다.
+    """
+    n_rows = len(X)
+    k = min(k, n_rows)
+    rng = np.random.default_rng(seed)
+    best = None
+    for _ in range(n_init):
+        # k-means++ 초기화: 가까운 중심까지 거리의 제곱에 비례해 다음 중심을 뽑음
+        centroids = X[[rng.integers(n_rows)]]
+        closest = _sq_distances(X, centroids)[:, 0]
+        for _ in range(1, k):
+            total = closest.sum()
+            pick = rng.choice(n_rows, p=closest / total) if total > 0 else rng.integers(n_rows)
+            centroids = np.vstack([centroids, X[pick]])
+            closest = np.minimum(closest, _sq_distances(X, X[[pick]])[:, 0])
+
+        if batch_size and n_rows > batch_size:
+            seen = np.zeros(k)
+            for _ in range(max_iter):
+                batch = X[rng.integers(0, n_rows, batch_size)]
+                sums, counts = _cluster_sums(batch, _sq_distances(batch, centroids).argmin(axis=1), k)
+                seen += counts
+                step = np.where(seen > 0, 1 / np.maximum(seen, 1), 0.0)[:, None]
+                centroids = centroids + step * (sums - counts[:, None] * centroids)
+        else:
+            for _ in range(max_iter):
+                labels = _sq_distances(X, centroids).argmin(axis=1)
+                sums, counts = _cluster_sums(X, labels, k)
+                updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+                # 빈 군집은 현재 중심에서 가장 먼 점으로 다시 시작
+                for empty in np.flatnonzero(counts == 0):
+                    updated[empty] = X[_sq_distances(X, updated).min(axis=1).argmax()]
+                shift = ((updated - centroids) ** 2).sum()
+                centroids = updated
+                if shift <= tol:
+                    break
+
+        d2 = _sq_distances(X, centroids)
+        labels = d2.argmin(axis=1)
+        inertia = d2[np.arange(n_rows), labels].sum()
+        if best is None or inertia < best[2]:
+            best = (centroids, labels, inertia)
+    return best
+
+PROFILE_CLUSTERS = 3
+PROFILE_BATCH_SIZE = 4096
+
+def profile_name(centroid, overall, items):
+    """반 평균과 가장 크게 다른 문항으로 프로필 이름을 붙입니다. (예: '긴장도 높음 · 재미 예상도 낮음')"""
+    deviation = centroid - overall
+    high, low = int(np.argmax(deviation)), int(np.argmin(deviation))
+    parts = []
+    if deviation[high] > 0.25:
+        parts.append(f'{items[high]} 높음')
+    if deviation[low] < -0.25:
+        parts.append(f'{items[low]} 낮음')
+    return ' · '.join(parts) or '반 평균과 비슷함'
+
+def student_profiles(student_means, k=PROFILE_CLUSTERS):
+    """학생별 평균 벡터를 k-means로 묶어 (프로필별 중심 표, 학생별 배정 표)를 반환합니다."""
+    items = list(student_means.columns)
+    if len(student_means) == 0:
+        return pd.DataFrame(columns=items + ['학생 수']), pd.DataFrame(columns=['학생 이름', '프로필', '중심까지 거리'])
+    X = student_means.to_numpy(dtype=float)
+    centroids, labels, _ = kmeans(X, k, batch_size=PROFILE_BATCH_SIZE)
+    overall = X.mean(axis=0)
+    # 학생 수가 많은 프로필부터 번호를 매김
+    counts = np.bincount(labels, minlength=len(centroids))
+    order = np.argsort(-counts, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    names = [f'프로필 {rank[c] + 1}: {profile_name(centroids[c], overall, items)}' for c in range(len(centroids))]
+    centers = pd.DataFrame(centroids[order], index=[names[c] for c in order], columns=items)
+    centers['학생 수'] = counts[order]
+    members = pd.DataFrame({
+        '학생 이름': student_means.index,
+        '프로필': [names[c] for c in labels],
+        '중심까지 거리': np.sqrt(_sq_distances(X, centroids)[np.arange(len(X)), labels]),
+    }).sort_values(['프로필', '중심까지 거리'], ignore_index=True)
+    return centers, members
+
+def stream_moments(frames, items=NUMERIC_COLUMNS, missing_as_zero=False):
+    """데이터프레임 묶음(시트, 청크 등)을 차례로 읽어 하나의 누적기로 요약합니다."""
+    accumulator = MomentAccumulator(len(items))
+    for frame in frames:
+        accumulator.update(item_matrix(frame, items, missing_as_zero))
+    return accumulator
+
+# 자유 응답 분석
+TEXT_COLUMNS = ['수업 요약', '자기 평가']
+TOKEN_PATTERN = re.compile(r'[가-힣]+|[A-Za-z]+|\d+')
+# 길이가 긴 것부터 떼어내는 조사·어미 (남는 부분이 두 글자 이상일 때만)
+KOREAN_SUFFIXES = sorted([
+    '은', '는', '이', '가', '을', '를', '에', '의', '와', '과', '도', '로', '만', '고', '서', '요',
+    '에서', '으로', '에게', '한테', '까지', '부터', '보다', '처럼', '이랑', '라고', '이라',
+    '했다', '였다', '었다', '았다', '해요', '하다', '했고', '해서', '하는', '하고', '했어요', '었어요', '았어요',
+    '합니다', '습니다', '입니다', '이었다', '있었다', '웠다', '웠어요',
+], key=len, reverse=True)
+STOPWORDS = {'오늘', '수업', '그리고', '정말', '너무', '조금', '그냥', '것', '수', '등', '더', '잘', '좀', '때', '때문'}
+TOP_TERMS = 30
+
+@lru_cache(maxsize=100_000)
+def tokenize_response(text):
+    """응답 하나를 단어 빈도 튜플로 나눕니다. 같은 문장은 한 번만 토큰화하도록 응답 단위로 캐시합니다."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        stripped = True
+        while stripped:
+            stripped = False
+            for suffix in KOREAN_SUFFIXES:
+                if token.endswith(suffix) and len(token) - len(suffix) >= 2:
+                    token = token[:-len(suffix)]
+                    stripped = True
+                    break
+        if len(token) >= 2 and token not in STOPWORDS:
+            tokens.append(token)
+    return tuple(Counter(tokens).items())
+
+def response_terms(texts):
+    """여러 응답의 단어 빈도를 합친 Counter를 반환합니다. (비어 있는 응답은 건너뜀)"""
+    counts = Counter()
+    for text in texts:
+        if isinstance(text, str) and text.strip():
+            counts.update(dict(tokenize_response(text)))
+    return counts
+
+QUERY_GROUP_SEPARATOR = re.compile(r'[,;/]+')  # 쉼표 등으로 나눈 묶음은 하나라도 맞으면 (또는)
+QUERY_SEPARATOR = re.compile(r'\s+')            # 한 묶음 안의 띄어쓴 단어는 모두 포함해야 함 (그리고)
+QUERY_PUNCTUATION = '.!?\'"()[]·…'
+
+class ResponseIndex:
+    """자유 응답에 대한 글자 n-gram 역색인입니다. 띄어쓰기 없이 붙는 한국어 조사에도 부분 일치로 찾을 수 있습니다.
+
+    응답마다 어절 안의 1-gram과 2-gram을 색인하고, 검색어의 n-gram 목록을 짧은 것부터 교집합한 뒤
+    후보 응답에서만 실제 포함 여부를 확인합니다. 새 응답은 add로 덧붙이기만 합니다.
+    """
+
+    def __init__(self, n=2):
+        self.n = n
+        self.documents = []   # (학생 이름, 세션, 문항, 응답)
+        self.postings = {}    # n-gram -> 응답 번호 목록 (오름차순)
+
+    def _grams(self, text):
+        grams = set()
+        for word in text.lower().split():
+            for size in range(1, self.n + 1):
+                grams.update(word[i:i + size] for i in range(len(word) - size + 1))
+        return grams
+
+    def add(self, student, session, column, text):
+        if not isinstance(text, str) or not text.strip():
+            return
+        doc_id = len(self.documents)
+        self.documents.append((student, session, column, text))
+        for gram in self._grams(text):
+            self.postings.setdefault(gram, []).append(doc_id)
+
+    def search(self, query):
+        """검색어에 맞는 응답 번호를 반환합니다.
+
+        쉼표(또는 ; /)로 나눈 묶음 중 하나라도 맞으면 찾고, 한 묶음 안의 띄어쓴 단어는 모두 포함해야 합니다.
+        (예: '분수, 일차 방정식' -> '분수'가 있거나 '일차'와 '방정식'이 모두 있는 응답, 앞뒤 문장부호는 무시)
+        """
+        matches = set()
+        for group in QUERY_GROUP_SEPARATOR.split(query.lower()):
+            words = [word.strip(QUERY_PUNCTUATION) for word in QUERY_SEPARATOR.split(group)]
+            words = [word for word in words if word]
+            if words:
+                matches.update(self._search_all(words))
+        return sorted(matches)
+
+    def _search_all(self, words):
+        """모든 단어를 포함하는 응답 번호 집합을 반환합니다."""
+        query_grams = set()
+        for word in words:
+            # 긴 검색어는 2-gram만으로 충분히 좁혀짐
+            query_grams.update(gram for gram in self._grams(word) if len(gram) == min(self.n, len(word)))
+        lists = sorted((self.postings.get(gram, []) for gram in query_grams), key=len)
+        if not lists or not lists[0]:
+            return set()
+        candidates = set(lists[0])
+        for posting in lists[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return set()
+        return {doc_id for doc_id in candidates
+                if all(word in self.documents[doc_id][3].lower() for word in words)}
+
+# 위험 신호 감지: 문항별로 나빠지는 방향 (+1: 오르면 위험, -1: 내려가면 위험)
+ALERT_ITEMS = {'긴장도': 1, '이해도': -1, '자신감': -1}
+ALERT_WINDOW = 3        # 최근 몇 개 세션을 볼지
+ALERT_THRESHOLD = 1.0   # 이전 세션 평균 대비 이만큼(점) 나빠지면 경고
+# 최근 세션 평균 - 이전 세션 평균 ('긴장도 변화' 같은 설문 문항 이름과 헷갈리지 않도록 '차이'로 표시)
+ALERT_COLUMNS = ['학생 이름', '최근 세션', '세션 수', *[f'{item} 차이' for item in ALERT_ITEMS], '경고', '위험도']
+
+class StudentWindow:
+    """학생 한 명의 최근 ALERT_WINDOW개 세션에 대한 경고 문항 합계와 응답 수를 보관하는 이동 창입니다."""
+
+    def __init__(self, size=ALERT_WINDOW):
+        self.size = size
+        self.sessions = []
+        self.sums = []
+        self.counts = []
+
+    def add(self, session, sums, counts):
+        """세션의 문항 합계와 응답 수를 더합니다. 창보다 오래된 세션이면 무시하고 False를 반환합니다."""
+        position = bisect.bisect_left(self.sessions, session)
+        if position == len(self.sessions) or self.sessions[position] != session:
+            if len(self.sessions) >= self.size and position == 0:
+                return False
+            self.sessions.insert(position, session)
+            self.sums.insert(position, np.zeros(len(sums)))
+            self.counts.insert(position, np.zeros(len(counts)))
+            if len(self.sessions) > self.size:
+                del self.sessions[0], self.sums[0], self.counts[0]
+                position -= 1
+        self.sums[position] += sums
+        self.counts[position] += counts
+        return True
+
+    def alert(self, name, directions=tuple(ALERT_ITEMS.values()), threshold=ALERT_THRESHOLD):
+        """가장 최근 세션과 창 안의 이전 세션 평균을 비교해 경고 행을 만듭니다. 경고가 없으면 None을 반환합니다."""
+        if len(self.sessions) < 2:
+            return None
+        sums, counts = np.array(self.sums), np.array(self.counts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            latest = sums[-1] / counts[-1]
+            earlier = sums[:-1].sum(axis=0) / counts[:-1].sum(axis=0)
+        change = latest - earlier
+        worse = np.nan_to_num(change * np.array(directions), nan=0.0)
+        flagged = worse >= threshold
+        if not flagged.any():
+            return None
+        labels = [f"{item} {'상승' if direction > 0 else '하락'}"
+                  for (item, direction), hit in zip(ALERT_ITEMS.items(), flagged) if hit]
+        return dict(zip(ALERT_COLUMNS, [name, self.sessions[-1], len(self.sessions), *change,
+                                        ', '.join(labels), int(flagged.sum())]), 악화=worse.max())
+
+class SurveyAggregates:
+    """데이터셋 하나(스프레드시트 ID, 범위)에 대한 전체/세션별/학생별 누적 통계입니다.
+
+    설문 응답은 아래에 덧붙여지므로 이전에 반영한 행 수 이후의 새 행만 더합니다.
+    행 수가 줄었거나 이미 반영한 행 중 하나라도 바뀌었으면(응답 수정·삭제) 처음부터 다시 집계합니다.
+    결측값은 건너뛰며, missing_as_zero이면 이전 차트와 같이 0점으로 계산합니다.
+    """
+
+    items = NUMERIC_COLUMNS
+
+    def __init__(self, default_session, missing_as_zero=False):
+        self.default_session = default_session
+        self.missing_as_zero = missing_as_zero
+        self.lock = threading.Lock()
+        self.version = None
+        self._reset()
+
+    def _reset(self):
+        self.overall = MomentAccumulator(len(self.items))
+        self.score_counts = np.zeros((len(self.items), len(LIKERT_SCORES)), dtype=np.int64)
+        self.by_session = {}
+        self.by_student = {}
+        self.rows_ingested = 0
+        self._row_hashes = np.empty(0, dtype=np.uint64)
+        self._profiles = {}
+        self._mean_ci = {}
+        self.windows = {}
+        self.alerts = {}
+        self._alert_table = None
+        self.term_counts = {column: Counter() for column in TEXT_COLUMNS}
+        self.session_terms = {}
+        self.text_index = ResponseIndex()
+
+    def ingest(self, df, version=None, row_hashes=None):
+        """데이터프레임에서 아직 반영하지 않은 행만 누적값에 더합니다. row_hashes는 행별 내용 해시입니다. (없으면 계산)"""
+        with self.lock:
+            if version is not None and version == self.version:
+                return
+            if row_hashes is None:
+                row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+            n = self.rows_ingested
+            if len(df) < n or not np.array_equal(row_hashes[:n], self._row_hashes):
+                # 이미 반영한 행이 수정·삭제되었으면 증분으로 맞출 수 없으므로 처음부터 다시 집계
+                self._reset()
+                n = 0
+
+            new_rows = df.iloc[n:]
+            if not new_rows.empty and all(item in df.columns for item in self.items):
+                X = item_matrix(new_rows, self.items, self.missing_as_zero)
+                self.overall.update(X)
+                self.score_counts += likert_counts(X)
+
+                sessions = session_labels(new_rows, self.default_session).to_numpy()
+                for session, positions in pd.Series(sessions).groupby(sessions).indices.items():
+                    self.by_session.setdefault(session, MomentAccumulator(len(self.items))).update(X[positions])
+
+                if '학생 이름' in new_rows.columns:
+                    for name, positions in new_rows.groupby('학생 이름', sort=False).indices.items():
+                        self.by_student.setdefault(name, MomentAccumulator(len(self.items))).update(X[positions])
+                    self._update_alerts(new_rows['학생 이름'].to_numpy(), sessions, X)
+            if not new_rows.empty:
+                self._update_terms(new_rows)
+
+            self.rows_ingested = len(df)
+            self._row_hashes = row_hashes
+            self.version = version
+            self._profiles = {}
+            self._mean_ci = {}
+
+    def _update_terms(self, new_rows):
+        """새 응답만 토큰화해 문항별·세션별 단어 빈도에 더합니다."""
+        columns = [column for column in TEXT_COLUMNS if column in new_rows.columns]
+        if not columns:
+            return
+        sessions = session_labels(new_rows, self.default_session).to_numpy()
+        for session, positions in pd.Series(sessions).groupby(sessions).indices.items():
+            session_counts = self.session_terms.setdefault(session, Counter())
+            for column in columns:
+                counts = response_terms(new_rows[column].iloc[positions])
+                self.term_counts[column].update(counts)
+                session_counts.update(counts)
         
-        sheet = service.spreadsheets()
+        # 검색용 역색인에도 새 응답만 덧붙임
+        students = new_rows['학생 이름'].to_numpy() if '학생 이름' in new_rows.columns else np.full(len(new_rows), None)
+        for column in columns:
+            for student, session, text in zip(students, sessions, new_rows[column].to_numpy()):
+                self.text_index.add(student, session, column, text)
+
+    def search_responses(self, query):
+        """검색어가 들어간 자유 응답을 (학생 이름, 세션, 문항, 응답) 표로 반환합니다."""
+        with self.lock:
+            documents = [self.text_index.documents[doc_id] for doc_id in self.text_index.search(query)]
+        return pd.DataFrame(documents, columns=['학생 이름', '세션', '문항', '응답'])
+
+    def top_terms(self, n=TOP_TERMS, column=None):
+        """반 전체(또는 한 문항)에서 자주 쓰인 단어 n개를 (단어, 빈도) 목록으로 반환합니다."""
+        with self.lock:
+            if column is not None:
+                return self.term_counts.get(column, Counter()).most_common(n)
+            return sum(self.term_counts.values(), Counter()).most_common(n)
+
+    def session_top_terms(self, n=5):
+        """세션별 상위 단어 표를 반환합니다."""
+        with self.lock:
+            rows = [{'세션': session, '응답 단어 수': sum(counts.values()),
+                     '상위 단어': ', '.join(f'{term}({count})' for term, count in counts.most_common(n))}
+                    for session, counts in sorted(self.session_terms.items())]
+        return pd.DataFrame(rows, columns=['세션', '응답 단어 수', '상위 단어'])
+
+    def _update_alerts(self, names, sessions, X):
+        """새 행을 (학생, 세션)별로 묶어 해당 학생의 이동 창만 갱신하고 경고를 다시 판정합니다."""
+        columns = [self.items.index(item) for item in ALERT_ITEMS]
+        values = X[:, columns]
+        answered = ~np.isnan(values)
+        sums = pd.DataFrame(np.where(answered, values, 0.0)).groupby([names, sessions], sort=False).sum()
+        counts = pd.DataFrame(answered.astype(float)).groupby([names, sessions], sort=False).sum()
+        touched = set()
+        for (name, session), group_sums, group_counts in zip(sums.index, sums.to_numpy(), counts.to_numpy()):
+            if self.windows.setdefault(name, StudentWindow()).add(session, group_sums, group_counts):
+                touched.add(name)
+        for name in touched:
+            alert = self.windows[name].alert(name)
+            if alert is None:
+                self.alerts.pop(name, None)
+            else:
+                self.alerts[name] = alert
+        if touched:
+            self._alert_table = None
+
+    def alert_table(self):
+        """미리 계산해 둔 경고 목록을 위험도 순서의 표로 반환합니다. 경고가 바뀌지 않았으면 같은 표를 재사용합니다."""
+        with self.lock:
+            if self._alert_table is None:
+                table = pd.DataFrame(list(self.alerts.values()), columns=ALERT_COLUMNS + ['악화'])
+                self._alert_table = (table.sort_values(['위험도', '악화'], ascending=False)
+                                     .drop(columns='악화').reset_index(drop=True))
+            return self._alert_table
+
+    def item_distribution(self):
+        """문항별 점수(1~5) 응답 수 표를 반환합니다."""
+        with self.lock:
+            return pd.DataFrame(self.score_counts.copy(), index=self.items, columns=LIKERT_SCORES)
+
+    # 폴러나 미리 그리기 스레드가 새 행을 더하는 중에 절반만 갱신된 값을 읽지 않도록 잠금 안에서 읽음
+    def item_counts(self):
+        with self.lock:
+            return pd.Series(self.overall.counts(), index=self.items)
+
+    def item_means(self):
+        with self.lock:
+            return pd.Series(self.overall.mean(), index=self.items)
+
+    def item_stds(self):
+        with self.lock:
+            return pd.Series(self.overall.std(), index=self.items)
+
+    def item_corr(self):
+        with self.lock:
+            return pd.DataFrame(self.overall.corr(), index=self.items, columns=self.items)
+
+    def reliability(self):
+        """누적 공분산으로 척도 신뢰도 표와 문항 분석 표를 계산합니다."""
+        with self.lock:
+            return scale_reliability(self.overall, self.items)
+
+    def student_means(self):
+        """학생별 문항 평균 행렬을 반환합니다. 학생이 답하지 않은 문항은 반 전체 평균으로 채웁니다."""
+        names = sorted(self.by_student)
+        if not names:
+            return pd.DataFrame(columns=self.items, dtype=float)
+        means = np.vstack([self.by_student[name].mean() for name in names])
+        means = np.where(np.isnan(means), self.overall.mean(), means)
+        return pd.DataFrame(means, index=pd.Index(names, name='학생 이름'), columns=self.items)
+
+    def mean_ci(self, df, n_resamples=BOOTSTRAP_RESAMPLES):
+        """문항별 평균 신뢰구간 (하한, 상한, 설명)을 데이터 버전마다 한 번만 계산합니다. df는 이 저장소에 반영한 데이터입니다."""
+        with self.lock:
+            cached = self._mean_ci.get(n_resamples)
+            if cached is None:
+                cached = items_mean_ci(df, self.overall.mean(), self.overall.std(), self.overall.counts(),
+                                       n_resamples, self.missing_as_zero)
+                self._mean_ci[n_resamples] = cached
+            return cached
+
+    def student_profiles(self, k=PROFILE_CLUSTERS):
+        """학생별 평균 벡터를 k개 응답 프로필로 묶습니다. 같은 데이터 버전에서는 계산한 결과를 재사용합니다."""
+        with self.lock:
+            cached = self._profiles.get(k)
+            if cached is None:
+                cached = student_profiles(self.student_means(), k)
+                self._profiles[k] = cached
+            return cached
+
+class AggregateRegistry:
+    """(스프레드시트 ID, 범위)별 SurveyAggregates를 보관합니다."""
+
+    def __init__(self):
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, missing_as_zero=False):
+        with self._lock:
+            return self._stores.get((key, missing_as_zero))
+
+    def drop(self, key):
+        """데이터셋이 캐시에서 내려가면 그 키의 집계 저장소를 (무응답 처리 방식별로 모두) 지웁니다."""
+        with self._lock:
+            for missing_as_zero in (False, True):
+                self._stores.pop((key, missing_as_zero), None)
+
+    def update(self, key, entry, missing_as_zero=False):
+        """데이터셋 항목의 새 행을 반영한 집계 저장소를 반환합니다."""
+        with self._lock:
+            store = self._stores.get((key, missing_as_zero))
+            if store is None:
+                store = SurveyAggregates(session_name_from_range(key[1]), missing_as_zero)
+                self._stores[(key, missing_as_zero)] = store
+        store.ingest(entry.df, entry.version, entry.row_hashes)
+        return store
+
+@st.cache_resource
+def get_aggregate_registry():
+    """프로세스 공용 집계 저장소 레지스트리를 반환합니다. 데이터셋 캐시에서 내려간 키의 집계도 함께 지웁니다."""
+    registry = AggregateRegistry()
+    DATASET_CACHE.add_eviction_listener(registry.drop)
+    return registry
+
+AGGREGATES = get_aggregate_registry()
+
+# 세션별 추이 (날짜 이름 시트)
+TREND_RESCAN_SECONDS = 10 * 60
+TREND_SMOOTHING = 3           # 이동 평균에 쓰는 세션 수
+TREND_CHANGE_THRESHOLD = 0.5  # 이 점수 이상 평균이 바뀐 지점을 변화 시점으로 표시
+
+class SessionTrendStore:
+    """스프레드시트별로 세션(날짜) 단위 누적 통계와 추이 표를 보관합니다.
+
+    시트마다 처음 반영할 때 세션별 누적기를 복사해 두므로, 추이를 볼 때 날짜별 시트를 다시 가져오지 않습니다.
+    같은 시트가 다시 반영되면(응답 추가) 그 시트에서 온 세션만 교체합니다. 추이 표는 바뀔 때만 다시 만듭니다.
+    """
+
+    def __init__(self):
+        self._sessions = {}   # 스프레드시트 ID -> {세션: (시트, 누적기)}
+        self._sources = {}    # 스프레드시트 ID -> {시트: 반영한 데이터 버전}
+        self._trends = {}     # 스프레드시트 ID -> (추이 버전, 추이 표)
+        self._scanned_at = {}
+        self._lock = threading.Lock()
+
+    def has_source(self, spreadsheet_id, source):
+        with self._lock:
+            return source in self._sources.get(spreadsheet_id, {})
+
+    def needs_scan(self, spreadsheet_id):
+        with self._lock:
+            return time.time() - self._scanned_at.get(spreadsheet_id, 0) > TREND_RESCAN_SECONDS
+
+    def mark_scanned(self, spreadsheet_id):
+        with self._lock:
+            self._scanned_at[spreadsheet_id] = time.time()
+
+    def skip(self, spreadsheet_id, source):
+        """설문 문항이 없는 시트를 세션 없이 반영한 것으로 기록해, 다음 확인 때 다시 가져오지 않게 합니다."""
+        with self._lock:
+            self._sources.setdefault(spreadsheet_id, {}).setdefault(source, None)
+
+    def record(self, spreadsheet_id, source, aggregates):
+        """시트 하나의 세션별 누적값을 저장합니다. 이미 같은 버전을 반영했으면 아무 것도 하지 않습니다."""
+        with aggregates.lock:
+            version = aggregates.version
+            snapshot = {session: MomentAccumulator.combine([accumulator], len(aggregates.items))
+                        for session, accumulator in aggregates.by_session.items()}
+        with self._lock:
+            sources = self._sources.setdefault(spreadsheet_id, {})
+            if source in sources and version is not None and sources[source] == version:
+                return
+            sessions = self._sessions.setdefault(spreadsheet_id, {})
+            for session in [session for session, (origin, _) in sessions.items() if origin == source]:
+                del sessions[session]
+            for session, accumulator in snapshot.items():
+                sessions[session] = (source, accumulator)
+            sources[source] = version
+            self._trends.pop(spreadsheet_id, None)
+
+    def trend(self, spreadsheet_id):
+        """(추이 버전, 세션×문항 평균 표)를 반환합니다. 표에는 세션별 응답 수 'n' 컬럼이 있습니다."""
+        with self._lock:
+            cached = self._trends.get(spreadsheet_id)
+            if cached is None:
+                sessions = self._sessions.get(spreadsheet_id, {})
+                names = sorted(sessions)
+                means = [sessions[name][1].mean() for name in names]
+                table = pd.DataFrame(np.vstack(means) if means else np.empty((0, len(NUMERIC_COLUMNS))),
+                                     index=pd.Index(names, name='세션'), columns=NUMERIC_COLUMNS)
+                table['n'] = [sessions[name][1].count for name in names]
+                cached = (hashlib.blake2b(pd.util.hash_pandas_object(table).to_numpy().tobytes(),
+                                          digest_size=8).hexdigest(), table)
+                self._trends[spreadsheet_id] = cached
+            return cached
+
+@st.cache_resource
+def get_trend_store():
+    """프로세스 공용 세션 추이 저장소를 반환합니다."""
+    return SessionTrendStore()
+
+TRENDS = get_trend_store()
+
+def ingest_dated_sheets(service, spreadsheet_id, rescan=False):
+    """날짜 이름 시트 중 아직 반영하지 않은 시트만 한 번씩 가져와 세션 집계로 저장합니다.
+
+    시트 목록은 TREND_RESCAN_SECONDS마다(또는 rescan이면 바로) 한 번만 확인합니다. 설문 문항이 없는 시트는
+    빈 시트로 기록해 다시 가져오지 않고, 가져오지 못한 시트는 건너뛰었다가 다음 확인 때 다시 시도합니다.
+    (새로 반영한 시트 수, [(시트 이름, 오류 메시지)])를 반환합니다.
+    """
+    if not (rescan or TRENDS.needs_scan(spreadsheet_id)):
+        return 0, []
+    added, failed = 0, []
+    try:
+        metadata = execute_request(service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields='sheets.properties.title'))
+        titles = [sheet['properties']['title'] for sheet in metadata.get('sheets', [])]
+        new_titles = [title for title in titles
+                      if re.search(SESSION_DATE_PATTERN, title) and not TRENDS.has_source(spreadsheet_id, title)]
+        for title in new_titles:
+            try:
+                df = fetch_sheet_frame(service, spreadsheet_id, f"{quote_sheet_name(title)}!A:Z")
+            except Exception as e:
+                failed.append((title, str(e)))
+                continue
+            if df is None or not all(item in df.columns for item in NUMERIC_COLUMNS):
+                TRENDS.skip(spreadsheet_id, title)
+                continue
+            store = SurveyAggregates(session_name_from_range(title))
+            store.ingest(df)
+            TRENDS.record(spreadsheet_id, title, store)
+            added += 1
+    finally:
+        TRENDS.mark_scanned(spreadsheet_id)
+    return added, failed
+
+def change_points(table, threshold=TREND_CHANGE_THRESHOLD, min_size=2):
+    """문항별로 평균이 가장 크게 달라지는 세션 하나를 찾습니다 (평균 이동 모형의 제곱오차 감소가 최대인 분할).
+
+    모든 문항을 누적합으로 한 번에 계산하며, 전후 평균 차이가 threshold 미만이면 변화 없음으로 봅니다.
+    {문항: (변화가 시작된 세션 위치, 전후 평균 차이)}를 반환합니다.
+    """
+    X = table.to_numpy(dtype=float)
+    n_sessions = len(X)
+    if n_sessions < 2 * min_size:
+        return {}
+    # 무응답 세션은 문항 평균으로 채움 (분할 위치에는 영향이 작음)
+    X = np.where(np.isnan(X), np.nanmean(X, axis=0), X)
+    splits = np.arange(min_size, n_sessions - min_size + 1)
+    cumulative = np.cumsum(X, axis=0)
+    left = cumulative[splits - 1] / splits[:, None]
+    right = (cumulative[-1] - cumulative[splits - 1]) / (n_sessions - splits)[:, None]
+    gain = splits[:, None] * (n_sessions - splits)[:, None] / n_sessions * (right - left) ** 2
+    best = np.nan_to_num(gain, nan=-1.0).argmax(axis=0)
+    shift = (right - left)[best, np.arange(X.shape[1])]
+    return {item: (int(splits[b]), float(d)) for item, b, d in zip(table.columns, best, shift) if abs(d) >= threshold}
+
+def render_trend_chart(trend, smoothing=TREND_SMOOTHING):
+    """세션별 문항 평균 추이를 문항마다 작은 그래프로 그리고, 이동 평균과 변화 시점을 함께 표시합니다."""
+    means = trend[NUMERIC_COLUMNS]
+    smoothed = means.rolling(smoothing, min_periods=1).mean()
+    shifts = change_points(means)
+    x = np.arange(len(means))
+    fig = new_figure(figsize=(16, 7), dpi=100)
+    axes = fig.subplots(2, 5, sharey=True)
+    try:
+        for ax, item in zip(axes.ravel(), NUMERIC_COLUMNS):
+            ax.plot(x, means[item], marker='o', color='#F8A978', alpha=0.5, linewidth=1)
+            ax.plot(x, smoothed[item], color='#7D5A50', linewidth=2.5)
+            if item in shifts:
+                start, delta = shifts[item]
+                ax.axvspan(start - 0.5, len(means) - 0.5, color='#FFB4B4' if delta < 0 else '#B4E4FF', alpha=0.4)
+                ax.annotate(f'{delta:+.2f}', (start, 0.3), fontsize=10, fontproperties=KOREAN_FONT)
+            ax.set_title(item, fontsize=12, fontweight='bold', fontproperties=KOREAN_FONT)
+            ax.set_ylim(0, 5)
+            ax.set_xticks(x)
+            ax.set_xticklabels([name[5:] if len(name) == 10 else name for name in means.index],
+                               rotation=90, fontsize=7, fontproperties=KOREAN_FONT)
+        fig.suptitle(f'세션별 문항 평균 추이 (굵은 선: {smoothing}회 이동 평균, 색 영역: 변화 시점 이후)',
+                     fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+        fig.tight_layout(pad=2.0)
         
+        return figure_to_base64(fig, dpi=200), None
+    except Exception as e:
+        return None, f"시각화 생성 중 오류가 발생했습니다: {str(e)}"
+
+def get_trend_chart(spreadsheet_id, smoothing=TREND_SMOOTHING):
+    """세션 추이 표와 차트를 추이 버전 기준으로 캐시에서 읽습니다. ((이미지, 오류), 추이 표)를 반환합니다."""
+    version, trend = TRENDS.trend(spreadsheet_id)
+    if trend.empty:
+        return (None, "세션별 데이터가 없습니다. 날짜 이름(예: 2025.03.10)으로 된 시트가 있는지 확인해주세요."), trend
+    key = ('trend', spreadsheet_id, version, smoothing)
+    img_str = CHART_CACHE.get(key)
+    if img_str is None:
+        img_str, error = render_trend_chart(trend, smoothing)
+        if error:
+            return (None, error), trend
+        CHART_CACHE.put(key, img_str)
+    return (img_str, None), trend
+
+def warm_dataset(key, entry):
+    """새로 들어온 데이터셋에 대해 요청 경로에서 쓰는 사전 계산 값을 미리 만들어 둡니다."""
+    entry.student_fingerprints()
+    store = AGGREGATES.update(key, entry)
+    # 지금 보고 있는 시트의 세션도 추이에 반영 (응답이 추가되면 그 세션만 교체)
+    # 날짜 시트 목록을 훑을 때와 같은 시트 이름을 출처로 써서 같은 시트를 다시 가져오지 않게 함
+    TRENDS.record(key[0], sheet_title(key[1]), store)
+    # 미리 그리기를 켜 둔 데이터셋이면 첫 클릭 전에 차트를 캐시에 채워 둠
+    CHART_WARMER.schedule(key, entry, store)
+
+def refresh_dataset(key, fetch, max_age=None):
+    """fetch로 데이터셋을 다시 조회해 공유 캐시에 넣고 DatasetEntry를 반환합니다. (조회 결과가 없으면 None)
+
+    같은 (스프레드시트 ID, 범위)의 조회가 이미 진행 중이면 새로 요청하지 않고 그 결과를 함께 씁니다.
+    max_age가 주어지면, 기다리는 사이 다른 요청이 이미 갱신한 최신 캐시를 그대로 씁니다.
+    """
+    def run():
+        if max_age is not None:
+            latest = DATASET_CACHE.get(key)
+            if latest is not None and latest.age() <= max_age:
+                return latest
+        df = fetch()
+        if df is None:
+            return None
+        entry = DATASET_CACHE.put(key, df)
+        warm_dataset(key, entry)
+        return entry
+    return FETCH_SINGLE_FLIGHT.do(key, run)
+
+# 백그라운드 자동 새로고침
+POLL_INTERVAL_SECONDS = 15
+POLL_MAX_BACKOFF_SECONDS = 300
+POLL_IDLE_TIMEOUT_SECONDS = 30 * 60
+
+class DatasetPoller:
+    """스프레드시트 하나를 주기적으로 다시 조회해 공유 캐시를 최신 상태로 유지하는 백그라운드 스레드입니다.
+
+    조회에 실패하면 간격을 두 배씩(최대 max_backoff초) 늘리며 다시 시도하고,
+    idle_timeout초 동안 아무도 데이터를 읽지 않으면 스스로 멈춥니다.
+    """
+
+    def __init__(self, key, service, interval=POLL_INTERVAL_SECONDS,
+                 max_backoff=POLL_MAX_BACKOFF_SECONDS, idle_timeout=POLL_IDLE_TIMEOUT_SECONDS):
+        self.key = key
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        self.failures = 0
+        self.last_error = None
+        self.last_success = None
+        self._service = service
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'mathdata-poller-{key[0][:8]}', daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread.is_alive() and not self._stop.is_set()
+
+    def is_healthy(self):
+        """최근 조회가 성공해 캐시가 충분히 최신인지 확인합니다."""
+        return self.is_alive() and self.failures == 0 and self.last_success is not None
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def set_interval(self, interval):
+        """간격을 바꾸고, 기다리는 중이면 새 간격 기준으로 다음 조회 시각을 다시 계산하게 합니다."""
+        if interval != self.interval:
+            self.interval = interval
+            self._wake.set()
+
+    def _sleep(self):
+        delay = self._next_delay()
+        started = time.time()
+        while not self._stop.is_set():
+            remaining = started + delay - time.time()
+            if remaining <= 0:
+                return
+            self._wake.wait(remaining)
+            self._wake.clear()
+            if self.failures == 0:
+                delay = self.interval
+
+    def _next_delay(self):
+        if self.failures == 0:
+            return self.interval
+        backoff = min(self.max_backoff, self.interval * 2 ** self.failures)
+        return backoff * random.uniform(0.8, 1.2)
+
+    def _run(self):
+        while not self._stop.is_set():
+            entry = DATASET_CACHE.get(self.key)
+            if entry is not None and time.time() - entry.last_access > self.idle_timeout:
+                break
+            try:
+                refresh_dataset(self.key, lambda: fetch_sheet_frame(self._service, *self.key))
+                self.failures = 0
+                self.last_error = None
+                self.last_success = time.time()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                entry = DATASET_CACHE.get(self.key)
+                if entry is not None:
+                    entry.failed_at = time.time()
+            self._sleep()
+        self._stop.set()
+
+class PollerRegistry:
+    """(스프레드시트 ID, 범위)마다 하나의 폴러만 돌도록 관리합니다.
+
+    폴러는 여러 세션이 함께 쓰므로 구독한 세션을 키마다 세어 두고, 마지막 구독이 풀릴 때만 멈춥니다.
+    새로고침 간격은 구독한 세션들이 요청한 간격 중 가장 짧은 값을 씁니다.
+    """
+
+    def __init__(self):
+        self._pollers = {}
+        self._subscribers = {}  # key -> {token: interval}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            poller = self._pollers.get(key)
+            return poller if poller is not None and poller.is_alive() else None
+
+    def subscribe(self, key, token, service, interval):
+        """token(세션별 식별자)으로 폴러를 구독하고, 돌고 있지 않으면 시작합니다."""
+        with self._lock:
+            poller = self._pollers.get(key)
+            if poller is None or not poller.is_alive():
+                # 유휴 시간 초과로 멈춘 폴러의 구독자는 이미 떠난 세션이므로 새로 셈
+                poller = DatasetPoller(key, service, interval)
+                self._pollers[key] = poller
+                self._subscribers[key] = {}
+            subscribers = self._subscribers[key]
+            subscribers[token] = interval
+            poller.set_interval(min(subscribers.values()))
+            return poller
+
+    def release(self, key, token):
+        """구독을 풀고, 남은 구독자가 없을 때만 폴러를 멈춥니다."""
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers is None or subscribers.pop(token, None) is None:
+                return
+            poller = self._pollers.get(key)
+            if subscribers:
+                if poller is not None:
+                    poller.set_interval(min(subscribers.values()))
+                return
+            del self._subscribers[key]
+            self._pollers.pop(key, None)
+        if poller is not None:
+            poller.stop()
+
+@st.cache_resource
+def get_poller_registry():
+    """프로세스 공용 폴러 레지스트리를 반환합니다."""
+    return PollerRegistry()
+
+POLLERS = get_poller_registry()
+
+class DatasetHandle:
+    """한 번의 스크립트 실행(rerun) 동안 세션의 모든 탭과 차트가 함께 쓰는 데이터셋 참조입니다."""
+
+    def __init__(self, key, run_id, entry, stale=False):
+        self.key = key
+        self.run_id = run_id
+        self.entry = entry
+        self.stale = stale  # 최신 조회에 실패해 마지막으로 성공한 데이터를 쓰는 중인지
+
+def session_token():
+    """이 브라우저 세션을 구분하는 식별자를 반환합니다 (공유 폴러 구독에 사용)."""
+    if 'session_token' not in st.session_state:
+        st.session_state['session_token'] = uuid.uuid4().hex
+    return st.session_state['session_token']
+
+def begin_run():
+    """새 스크립트 실행을 표시합니다. 이후의 load_dataset 호출은 이 실행 안에서 최대 한 번만 조회합니다."""
+    st.session_state['run_id'] = st.session_state.get('run_id', 0) + 1
+
+def load_dataset(spreadsheet_id, range_name, force=False, max_age=DATASET_TTL_SECONDS):
+    """세션의 데이터셋 핸들을 통해 데이터프레임을 가져옵니다.
+
+    같은 실행 안에서는 핸들이 가진 데이터프레임을 그대로 돌려주고, 그렇지 않으면 공유 캐시를 확인한 뒤
+    캐시가 없거나 max_age초보다 오래되었을 때만 스프레드시트를 다시 조회합니다.
+    다시 조회하지 못하면 마지막으로 성공한 데이터를 돌려주고 핸들에 stale 표시를 남깁니다.
+    """
+    key = make_dataset_key(spreadsheet_id, range_name)
+    run_id = st.session_state.get('run_id')
+    handle = st.session_state.get('dataset')
+    if not force and handle is not None and handle.key == key and handle.run_id == run_id:
+        return handle.entry.df
+
+    pending = st.session_state.pop('prefetch', None)
+    prefetch_error = None
+    if pending is not None and pending[0] == key:
+        # 미리 시작한 조회가 있으면 끝나기를 기다림
         try:
-            # 시트 목록 확인 (디버깅용)
-            sheets_metadata = sheet.get(spreadsheetId=spreadsheet_id).execute()
-            sheets = sheets_metadata.get('sheets', [])
-            sheet_names = [s.get("properties", {}).get("title", "") for s in sheets]
-            st.info(f"스프레드시트에 존재하는 시트: {', '.join(sheet_names)}")
-            
-            # 실제 데이터 가져오기
-            result = sheet.values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
-            values = result.get('values', [])
-            
-            if not values:
-                st.warning("데이터가 없습니다.")
-                return None
-            
-            # 헤더 행 가져오기
-            headers = values[0]
-            
-            # 실제 데이터 행 가져오기
-            data = values[1:]
-            
-            # 데이터프레임 생성
-            df = pd.DataFrame(data)
-            
-            # 컬럼 수가 맞지 않는 경우 처리
-            if len(headers) > len(df.columns):
-                # 부족한 컬럼 추가
-                for i in range(len(df.columns), len(headers)):
-                    df[i] = None
-            elif len(headers) < len(df.columns):
-                # 초과 컬럼 제거
-                df = df.iloc[:, :len(headers)]
-            
-            # 컬럼명 설정
-            df.columns = headers
-            
-            # 컬럼명 매핑
-            mapped_columns = {}
-            for orig_col in df.columns:
-                if orig_col in survey_columns:
-                    mapped_columns[orig_col] = survey_columns[orig_col]
-                else:
-                    # 매핑되지 않은 컬럼은 원래 이름 유지
-                    mapped_columns[orig_col] = orig_col
-            
-            # 컬럼명 변경
-            df = df.rename(columns=mapped_columns)
-            
-            # 숫자형 데이터 변환
-            numeric_columns = ['수업 기대도', '긴장도', '재미 예상도', '자신감', '집중도', 
-                             '즐거움', '자신감 변화', '재미 변화', '긴장도 변화', '이해도']
-            for col in numeric_columns:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col], errors='coerce')
-            
-            return df
-            
-        except Exception as api_error:
-            st.error(f"API 요청 중 오류 발생: {str(api_error)}")
-            st.info("시트 이름에 마침표(.)나 특수 문자가 포함된 경우, 일반적으로 Google Sheets API에서는 작은따옴표(')로 감싸야 합니다.")
-            st.info("예시: '2025.03.29.'!A1:O2 대신 Sheet1!A1:O2와 같은 단순한 시트 이름을 사용해보세요.")
+            pending[1].result()
+        except Exception as e:
+            prefetch_error = e
+    entry = DATASET_CACHE.get(key)
+    poller = POLLERS.get(key)
+    if poller is not None and poller.is_healthy():
+        # 백그라운드 폴러가 캐시를 최신으로 유지하므로 요청 경로에서는 조회하지 않음
+        max_age = float('inf')
+    stale = False
+    if prefetch_error is not None:
+        # 미리 시작한 조회가 이미 재시도 끝에 실패했으므로 다시 조회하지 않고 안내 후 마지막 데이터를 씀
+        show_fetch_notices(spreadsheet_id, range_name)
+        show_fetch_error(prefetch_error)
+        if entry is None:
             return None
-            
+        entry.failed_at = time.time()
+        stale = True
+    elif not force and entry is not None and entry.failed_at is not None \
+            and time.time() - entry.failed_at < STALE_RETRY_SECONDS:
+        # 방금 조회에 실패했으면 잠시 다시 시도하지 않고 마지막 데이터를 씀
+        stale = True
+    elif force or entry is None or entry.age() > max_age:
+        credentials = get_sheets_credentials()
+        
+        def fetch():
+            # 다른 세션이 이 조회를 함께 기다릴 수 있으므로 st.*는 호출하지 않음 (안내는 아래에서 이 세션이 직접 표시)
+            with SHEETS_SERVICES.lease(credentials) as service:
+                return fetch_sheet_frame(service, *key)
+        
+        # 여러 세션이 동시에 요청해도 조회는 한 번만 (방금 다른 세션이 갱신했으면 그 결과를 씀)
+        refreshed = None
+        if credentials is not None:
+            show_fetch_notices(spreadsheet_id, range_name)
+            try:
+                refreshed = refresh_dataset(key, fetch, None if force else max_age)
+                if refreshed is None:
+                    st.warning("데이터가 없습니다.")
+            except Exception as e:
+                # 다른 세션이나 폴러가 먼저 시작한 조회가 재시도 끝에 실패해도 화면이 깨지지 않도록 마지막 데이터로 넘어감
+                show_fetch_error(e)
+        if refreshed is not None:
+            entry = refreshed
+        elif entry is None:
+            return None
+        else:
+            entry.failed_at = time.time()
+            stale = True
+
+    entry.last_access = time.time()
+    st.session_state['dataset'] = DatasetHandle(key, run_id, entry, stale)
+    return entry.df
+
+def prefetch_dataset(spreadsheet_id, range_name, max_age=DATASET_TTL_SECONDS):
+    """스프레드시트 ID와 범위가 입력되면 데이터셋 조회를 백그라운드에서 미리 시작합니다.
+
+    조회하는 동안 스크립트는 나머지 화면을 계속 그리고, 이후의 load_dataset은 이 조회가 끝나기를 기다려 결과를 씁니다.
+    캐시가 최신이거나 폴러가 관리 중이면 아무것도 하지 않습니다.
+    """
+    key = make_dataset_key(spreadsheet_id, range_name)
+    spreadsheet_id, range_name = key
+    entry = DATASET_CACHE.get(key)
+    poller = POLLERS.get(key)
+    if entry is not None and (entry.age() <= max_age or (poller is not None and poller.is_healthy())
+                              or (entry.failed_at is not None and time.time() - entry.failed_at < STALE_RETRY_SECONDS)):
+        return None
+    credentials = get_sheets_credentials()
+    if credentials is None:
+        return None
+    
+    def fetch():
+        with SHEETS_SERVICES.lease(credentials) as service:
+            return fetch_sheet_frame(service, spreadsheet_id, range_name)
+    
+    future = FETCH_EXECUTOR.submit(refresh_dataset, key, fetch, max_age)
+    st.session_state['prefetch'] = (key, future)
+    return future
+
+# 여러 반 비교
+MULTI_CLASS_MAX_WORKERS = 8
+
+@st.cache_resource
+def get_fetch_executor():
+    """여러 스프레드시트를 동시에 조회하는 크기 제한 스레드 풀을 반환합니다."""
+    return ThreadPoolExecutor(max_workers=MULTI_CLASS_MAX_WORKERS, thread_name_prefix='mathdata-fetch')
+
+FETCH_EXECUTOR = get_fetch_executor()
+
+def parse_class_registry(text):
+    """'반 이름, 스프레드시트 ID, 범위' 형식의 줄들을 [(반 이름, ID, 범위)]로 바꿉니다. 반 이름은 생략할 수 있습니다."""
+    classes = []
+    for line in text.splitlines():
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) == 2 and all(fields):
+            classes.append((f'{len(classes) + 1}반', fields[0], fields[1]))
+        elif len(fields) >= 3 and all(fields[:3]):
+            classes.append((fields[0], fields[1], ','.join(fields[2:])))
+    return classes
+
+def _fetch_class(credentials, key):
+    """작업 스레드에서 반 하나를 조회해 공유 캐시에 넣습니다. (서비스 객체는 풀에서 빌려 혼자 씀)"""
+    def fetch():
+        with SHEETS_SERVICES.lease(credentials) as service:
+            return fetch_sheet_frame(service, *key)
+    
+    entry = refresh_dataset(key, fetch)
+    if entry is None:
+        raise ValueError("데이터가 없습니다.")
+    return entry
+
+def load_classes(credentials, classes, max_age=DATASET_TTL_SECONDS):
+    """여러 반의 데이터셋을 동시에 가져옵니다. 캐시가 최신인 반은 조회하지 않습니다.
+
+    전체 대기 시간은 가장 느린 조회 하나와 비슷합니다. {반 이름: (데이터셋 키, DatasetEntry 또는 None, 오류)}를 반환합니다.
+    """
+    results, futures = {}, {}
+    for name, spreadsheet_id, range_name in classes:
+        key = make_dataset_key(spreadsheet_id, range_name)
+        entry = DATASET_CACHE.get(key)
+        poller = POLLERS.get(key)
+        recently_failed = entry is not None and entry.failed_at is not None \
+            and time.time() - entry.failed_at < STALE_RETRY_SECONDS
+        if entry is not None and (entry.age() <= max_age or recently_failed
+                                  or (poller is not None and poller.is_healthy())):
+            results[name] = (key, entry, None)
+        else:
+            futures[name] = (key, FETCH_EXECUTOR.submit(_fetch_class, credentials, key))
+    for name, (key, future) in futures.items():
+        try:
+            results[name] = (key, future.result(), None)
+        except Exception as e:
+            # 조회에 실패하면 마지막으로 성공한 데이터가 있으면 그것을 씀
+            stale_entry = DATASET_CACHE.get(key)
+            if stale_entry is not None:
+                stale_entry.failed_at = time.time()
+                results[name] = (key, stale_entry, f"{str(e)} (마지막으로 가져온 데이터를 표시합니다)")
+            else:
+                results[name] = (key, None, str(e))
+    for _, entry, _ in results.values():
+        if entry is not None:
+            entry.last_access = time.time()
+    return results
+
+def render_class_comparison(class_aggregates):
+    """반별 문항 평균을 묶음 막대로 비교합니다. class_aggregates는 {반 이름: SurveyAggregates}입니다."""
+    names = list(class_aggregates)
+    width = 0.8 / len(names)
+    x = np.arange(len(NUMERIC_COLUMNS))
+    colors = sns.color_palette('Set2', len(names))
+    fig = new_figure(figsize=(12, 8), dpi=100)
+    try:
+        ax = fig.add_subplot(111)
+        for i, (name, color) in enumerate(zip(names, colors)):
+            aggregates = class_aggregates[name]
+            ax.bar(x + (i - (len(names) - 1) / 2) * width, aggregates.item_means(), width,
+                   yerr=aggregates.item_stds() / np.sqrt(np.maximum(aggregates.item_counts(), 1)),
+                   capsize=3, color=color, label=f'{name} (n={aggregates.overall.count})')
+        ax.set_title('반별 문항 평균 비교 (오차 막대: 표준오차)', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+        ax.set_xticks(x)
+        ax.set_xticklabels(NUMERIC_COLUMNS, rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
+        ax.set_ylabel('평균 점수 (1-5)', fontsize=12, fontproperties=KOREAN_FONT)
+        ax.set_ylim(0, 5)
+        ax.legend(prop=KOREAN_FONT, fontsize=10, loc='upper right')
+        fig.tight_layout(pad=3.0)
+        
+        return figure_to_base64(fig), None
     except Exception as e:
-        st.error(f"데이터를 가져오는 중 오류가 발생했습니다: {str(e)}")
-        return None
+        return None, f"시각화 생성 중 오류가 발생했습니다: {str(e)}"
+
+def get_class_comparison_chart(datasets, missing_as_zero=False):
+    """반별 비교 차트를 각 반의 데이터 버전 조합 기준으로 캐시합니다. datasets는 {반 이름: (데이터셋 키, DatasetEntry)}입니다."""
+    cache_key = ('compare', tuple((name, entry.version) for name, (_, entry) in datasets.items()), missing_as_zero)
+    img_str = CHART_CACHE.get(cache_key)
+    if img_str is not None:
+        return img_str, None
+    class_aggregates = {name: AGGREGATES.update(key, entry, missing_as_zero) for name, (key, entry) in datasets.items()}
+    img_str, error = render_class_comparison(class_aggregates)
+    if img_str:
+        CHART_CACHE.put(cache_key, img_str)
+    return img_str, error
+
+# 수업 전후 효과 분석
+# 같은 구성 개념을 수업 전과 후에 잰 문항 쌍만 짝지어 비교합니다. (수업 전 문항, 수업 후 문항, 표시 이름)
+EFFECT_PAIRS = [
+    ('수업 기대도', '즐거움', '기대 → 즐거움'),
+]
+# '자신감 변화', '재미 변화', '긴장도 변화'는 수업 후 수준이 아니라 "늘었다(긴장도는 덜 긴장된다)"에 대한 동의 정도이므로
+# 수업 전 문항과 빼지 않고, 중립 점수(3점)와 비교하는 단일 표본 검정으로 봅니다. (문항, 표시 이름)
+CHANGE_ITEMS = [
+    ('자신감 변화', '자신감 향상'),
+    ('재미 변화', '재미 향상'),
+    ('긴장도 변화', '긴장 완화'),
+]
+NEUTRAL_SCORE = 3
+EFFECT_COLUMNS = ['n', '기준', '비교', '차이', 'CI 하한', 'CI 상한', '효과크기(d)']
+
+def t_critical(dof, confidence=0.95):
+    """스튜던트 t 분포의 양측 임계값을 구합니다. 자유도 1, 2는 정확한 식, 3 이상은 Cornish-Fisher 전개를 씁니다."""
+    dof = np.asarray(dof, dtype=float)
+    p = (1 + confidence) / 2
+    z = NormalDist().inv_cdf(p)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        approx = (z + (z**3 + z) / (4 * dof)
+                  + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * dof**2)
+                  + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * dof**3)
+                  + (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / (92160 * dof**4))
+    exact_1 = np.tan(np.pi * (p - 0.5))
+    exact_2 = (2 * p - 1) / np.sqrt(2 * p * (1 - p))
+    return np.where(dof < 1, np.nan, np.where(dof == 1, exact_1, np.where(dof == 2, exact_2, approx)))
+
+def paired_effects(pre, post, codes, n_groups, confidence=0.95):
+    """짝지은 (행, 쌍) 행렬에서 그룹×쌍별 평균 차이(post - pre), 신뢰구간, 효과크기(Cohen's d)를 한 번에 계산합니다.
+
+    pre 열이 상수(중립 점수)이면 단일 표본 검정과 같습니다.
+
+    codes는 각 행의 그룹 번호(0 ~ n_groups-1, 음수는 제외)이며, 그룹별 합계는 bincount로 모든 쌍을 한꺼번에 구합니다.
+    반환값은 EFFECT_COLUMNS 순서의 (그룹, 쌍) 배열 딕셔너리입니다.
+    """
+    diff = post - pre
+    valid = ~np.isnan(diff) & (codes >= 0)[:, None]
+    n_pairs = diff.shape[1]
+    flat = (np.clip(codes, 0, None)[:, None] * n_pairs + np.arange(n_pairs)).ravel()
+    size = n_groups * n_pairs
+
+    def group_sum(values):
+        weights = np.where(valid, values, 0.0).ravel()
+        return np.bincount(flat, weights=weights, minlength=size).reshape(n_groups, n_pairs)
+
+    n = group_sum(np.ones_like(diff))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = group_sum(diff) / n
+        sd = np.sqrt(np.clip((group_sum(diff ** 2) - n * mean ** 2) / (n - 1), 0, None))
+        margin = t_critical(n - 1, confidence) * sd / np.sqrt(n)
+        return {
+            'n': n.astype(int),
+            '기준': group_sum(pre) / n,
+            '비교': group_sum(post) / n,
+            '차이': mean,
+            'CI 하한': mean - margin,
+            'CI 상한': mean + margin,
+            '효과크기(d)': np.where(sd > 0, mean / sd, np.nan),
+        }
+
+def lesson_effects(df, default_session='전체', confidence=0.95):
+    """수업 전후 문항 쌍의 차이와 변화 문항의 중립 대비 차이를 반 전체, 세션별, 학생별로 계산합니다.
+
+    짝지은 쌍은 '기준'이 수업 전 평균이고, 변화 문항은 '기준'이 중립 점수(3점)입니다.
+    {'class': 문항별 표, 'session': 세션×문항 표, 'student': 학생×문항 표}를 반환합니다.
+    """
+    pairs = [pair for pair in EFFECT_PAIRS if pair[0] in df.columns and pair[1] in df.columns]
+    changes = [change for change in CHANGE_ITEMS if change[0] in df.columns]
+    labels = [label for _, _, label in pairs] + [label for _, label in changes]
+    pre = np.hstack([df[[before for before, _, _ in pairs]].to_numpy(dtype=float),
+                     np.full((len(df), len(changes)), float(NEUTRAL_SCORE))])
+    post = df[[after for _, after, _ in pairs] + [item for item, _ in changes]].to_numpy(dtype=float)
+
+    def effect_table(codes, groups, group_column):
+        stats = paired_effects(pre, post, codes, len(groups), confidence)
+        table = pd.DataFrame({
+            group_column: np.repeat(groups, len(labels)),
+            '문항': np.tile(labels, len(groups)),
+            **{column: stats[column].ravel() for column in EFFECT_COLUMNS},
+        })
+        return table[table['n'] > 0].reset_index(drop=True)
+
+    results = {'class': effect_table(np.zeros(len(df), dtype=np.int64), np.array(['전체']), '그룹')
+               .drop(columns='그룹').set_index('문항')}
+    session_codes, sessions = pd.factorize(session_labels(df, default_session), sort=True)
+    results['session'] = effect_table(session_codes, np.asarray(sessions), '세션')
+    if '학생 이름' in df.columns:
+        student_codes, students = pd.factorize(df['학생 이름'], sort=True)
+        results['student'] = effect_table(student_codes, np.asarray(students), '학생 이름')
+    return results
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_lesson_effects(_df, version, default_session):
+    """데이터셋 버전별로 수업 전후 효과 분석 결과를 캐시합니다. (_df는 해시하지 않고 version을 키로 씀)"""
+    return lesson_effects(_df, default_session)
+
+def draw_lesson_effects(fig, effects):
+    """문항별 평균 차이와 신뢰구간을 점-오차 막대(forest plot)로 그립니다."""
+    ax = fig.add_subplot(111)
+    rows = np.arange(len(effects.index))
+    lower = effects['차이'] - effects['CI 하한']
+    upper = effects['CI 상한'] - effects['차이']
+    ax.errorbar(effects['차이'], rows, xerr=[lower, upper], fmt='o', color='#F8A978',
+                ecolor='#7D5A50', elinewidth=2, capsize=6, markersize=10)
+    ax.axvline(0, color='gray', linestyle='--', linewidth=1)
+    ax.set_yticks(rows)
+    ax.set_yticklabels(effects.index, fontsize=12, fontproperties=KOREAN_FONT)
+    ax.invert_yaxis()
+    ax.set_xlabel(f'차이 (점) · 짝지은 문항: 수업 후 - 수업 전, 변화 문항: 응답 - 중립 {NEUTRAL_SCORE}점',
+                  fontsize=12, fontproperties=KOREAN_FONT)
+    ax.set_title('수업 전후 효과 (오차 막대: 95% 신뢰구간)', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+    
+    # 효과크기와 응답 수 표시
+    for row, (_, effect) in zip(rows, effects.iterrows()):
+        ax.annotate(f"d={effect['효과크기(d)']:.2f}, n={int(effect['n'])}", (effect['CI 상한'], row),
+                    xytext=(8, 0), textcoords='offset points', va='center', fontsize=10, fontproperties=KOREAN_FONT)
+
+# 척도 신뢰도 분석
+SCALE_GROUPS = {
+    '수업 전 마음가짐': ['수업 기대도', '긴장도', '재미 예상도', '자신감'],
+    '수업 참여': ['집중도', '즐거움', '이해도'],
+    '수업 후 변화': ['자신감 변화', '재미 변화', '긴장도 변화'],
+    '전체 문항': NUMERIC_COLUMNS,
+}
+REVERSED_ITEMS = ['긴장도']  # 점수가 높을수록 부정적인 문항 (역채점)
+
+def scale_reliability(accumulator, items=NUMERIC_COLUMNS, groups=SCALE_GROUPS, reversed_items=REVERSED_ITEMS):
+    """누적 공분산 행렬 하나로 척도별 Cronbach 알파, 문항 제거 시 알파, 교정 문항-총점 상관을 계산합니다.
+
+    역채점 문항은 부호 벡터로 공분산의 행과 열 부호만 바꾸며, 원본 행은 다시 읽지 않습니다.
+    (척도 표, 문항 표)를 반환합니다.
+    """
+    sign = np.where(np.isin(items, reversed_items), -1.0, 1.0)
+    cov = accumulator.cov() * np.outer(sign, sign)
+    positions = {item: i for i, item in enumerate(items)}
+    scale_rows, item_rows = [], []
+    for scale, members in groups.items():
+        index = [positions[item] for item in members if item in positions]
+        k = len(index)
+        if k < 2:
+            continue
+        sub = cov[np.ix_(index, index)]
+        item_var = np.diag(sub)
+        total_var = sub.sum()
+        row_sums = sub.sum(axis=1)
+        # 문항 i를 뺀 나머지 합의 분산과 문항 i와의 공분산
+        rest_var = total_var - 2 * row_sums + item_var
+        rest_cov = row_sums - item_var
+        with np.errstate(invalid='ignore', divide='ignore'):
+            alpha = k / (k - 1) * (1 - item_var.sum() / total_var)
+            alpha_deleted = ((k - 1) / (k - 2) * (1 - (item_var.sum() - item_var) / rest_var)
+                             if k > 2 else np.full(k, np.nan))
+            item_total = rest_cov / np.sqrt(item_var * rest_var)
+        scale_rows.append({'척도': scale, '문항 수': k, 'α': alpha,
+                           'n': int(accumulator.pair_counts[np.ix_(index, index)].min())})
+        for j, i in enumerate(index):
+            item_rows.append({'척도': scale, '문항': items[i], '역채점': bool(sign[i] < 0),
+                              '교정 문항-총점 상관': item_total[j], '제거 시 α': alpha_deleted[j]})
+    return pd.DataFrame(scale_rows), pd.DataFrame(item_rows)
+
+def draw_scale_reliability(fig, scales, items):
+    """척도별 알파와 문항별 교정 문항-총점 상관을 나란히 그립니다."""
+    ax_alpha = fig.add_subplot(1, 2, 1)
+    ax_items = fig.add_subplot(1, 2, 2)
+    colors = dict(zip(scales['척도'], sns.color_palette('Set2', len(scales))))
+    
+    rows = np.arange(len(scales))
+    ax_alpha.barh(rows, scales['α'].fillna(0), color=[colors[scale] for scale in scales['척도']])
+    ax_alpha.axvline(0.7, color='gray', linestyle='--', linewidth=1)  # 흔히 쓰는 기준값
+    ax_alpha.set_yticks(rows)
+    ax_alpha.set_yticklabels([f'{scale}\n({k}문항, n={n})' for scale, k, n in zip(scales['척도'], scales['문항 수'], scales['n'])],
+                             fontsize=10, fontproperties=KOREAN_FONT)
+    ax_alpha.invert_yaxis()
+    ax_alpha.set_xlim(min(0, np.nanmin(scales['α'])) if len(scales) else 0, 1)
+    ax_alpha.set_xlabel('Cronbach α', fontsize=12, fontproperties=KOREAN_FONT)
+    ax_alpha.set_title('척도 신뢰도', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+    for row, alpha in zip(rows, scales['α']):
+        if not np.isnan(alpha):
+            ax_alpha.text(max(alpha, 0), row, f' {alpha:.2f}', va='center', fontproperties=KOREAN_FONT)
+    
+    # 전체 문항 척도는 문항별 막대에서 생략 (각 하위 척도와 중복)
+    detail = items[items['척도'] != '전체 문항'] if (items['척도'] != '전체 문항').any() else items
+    rows = np.arange(len(detail))
+    ax_items.barh(rows, detail['교정 문항-총점 상관'].fillna(0), color=[colors[scale] for scale in detail['척도']])
+    ax_items.axvline(0.3, color='gray', linestyle='--', linewidth=1)
+    ax_items.set_yticks(rows)
+    ax_items.set_yticklabels([f"{item}{' (역)' if flipped else ''}" for item, flipped in zip(detail['문항'], detail['역채점'])],
+                             fontsize=10, fontproperties=KOREAN_FONT)
+    ax_items.invert_yaxis()
+    ax_items.set_xlim(-1, 1)
+    ax_items.set_xlabel('교정 문항-총점 상관', fontsize=12, fontproperties=KOREAN_FONT)
+    ax_items.set_title('문항 분석 (괄호: 제거 시 α)', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+    for row, (r, alpha) in zip(rows, zip(detail['교정 문항-총점 상관'], detail['제거 시 α'])):
+        if not np.isnan(r):
+            label = f' {r:.2f}' + (f' ({alpha:.2f})' if not np.isnan(alpha) else '')
+            ax_items.text(r if r >= 0 else 0, row, label, va='center', fontsize=9, fontproperties=KOREAN_FONT)
+
+def draw_student_profiles(fig, centers, members):
+    """프로필별 중심 응답을 선 그래프로, 프로필별 학생 수를 막대로 그립니다."""
+    items = [column for column in centers.columns if column != '학생 수']
+    ax_lines = fig.add_subplot(1, 3, (1, 2))
+    ax_sizes = fig.add_subplot(1, 3, 3)
+    colors = sns.color_palette('Set2', len(centers))
+    
+    for color, (name, center) in zip(colors, centers.iterrows()):
+        ax_lines.plot(range(len(items)), center[items].to_numpy(dtype=float), marker='o', color=color,
+                      linewidth=2, label=f"{name} ({int(center['학생 수'])}명)")
+    ax_lines.set_title('학생 응답 프로필', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+    ax_lines.set_xticks(range(len(items)))
+    ax_lines.set_xticklabels(items, rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
+    ax_lines.set_ylabel('프로필 평균 점수 (1-5)', fontsize=12, fontproperties=KOREAN_FONT)
+    ax_lines.set_ylim(0, 5)
+    ax_lines.grid(True, linestyle='--', alpha=0.7)
+    ax_lines.legend(loc='lower left', prop=KOREAN_FONT, fontsize=9)
+    
+    rows = np.arange(len(centers))
+    ax_sizes.barh(rows, centers['학생 수'], color=colors)
+    ax_sizes.set_yticks(rows)
+    ax_sizes.set_yticklabels([name.split(':')[0] for name in centers.index], fontsize=10, fontproperties=KOREAN_FONT)
+    ax_sizes.invert_yaxis()
+    ax_sizes.set_xlabel('학생 수', fontsize=12, fontproperties=KOREAN_FONT)
+    ax_sizes.set_title('프로필별 학생 수', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+
+def draw_word_cloud(ax, terms, seed=BOOTSTRAP_SEED):
+    """matplotlib 텍스트만으로 단어 구름을 그립니다. 빈도가 높은 단어부터 나선을 따라 겹치지 않는 자리에 놓습니다."""
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    ax.axis('off')
+    if not terms:
+        return
+    rng = np.random.default_rng(seed)
+    colors = sns.color_palette('Oranges_r', 6)[:4] + sns.color_palette('copper', 3)
+    largest = terms[0][1]
+    placed = []  # (x0, y0, x1, y1) 축 좌표 기준 대략적인 글자 상자
+    # 축 크기(포인트)로 글자 크기를 축 좌표로 바꿈
+    width_points = ax.bbox.width * 72 / ax.figure.dpi
+    height_points = ax.bbox.height * 72 / ax.figure.dpi
+    for rank, (term, count) in enumerate(terms):
+        size = 9 + 23 * np.sqrt(count / largest)
+        # 글자 상자 크기 추정: 한글은 정사각형에 가깝고, 영문·숫자는 그 절반 정도
+        width = sum(1.0 if '가' <= ch <= '힣' else 0.6 for ch in term) * size / width_points
+        height = 1.2 * size / height_points
+        for step in range(1500):
+            angle = 0.35 * step + rng.uniform(0, 0.2)
+            radius = 0.0015 * step
+            x, y = 0.5 + radius * np.cos(angle), 0.5 + radius * np.sin(angle) * 0.7
+            box = (x - width / 2, y - height / 2, x + width / 2, y + height / 2)
+            inside = box[0] >= 0 and box[1] >= 0 and box[2] <= 1 and box[3] <= 1
+            if inside and all(box[2] < b[0] or box[0] > b[2] or box[3] < b[1] or box[1] > b[3] for b in placed):
+                placed.append(box)
+                ax.text(x, y, term, ha='center', va='center', fontsize=size,
+                        color=colors[rank % len(colors)], fontproperties=KOREAN_FONT)
+                break
+
+def draw_text_analytics(fig, terms, column_terms):
+    """상위 단어 빈도 막대, 문항별 상위 단어, 단어 구름을 함께 그립니다."""
+    ax_bar = fig.add_subplot(1, 2, 1)
+    ax_cloud = fig.add_subplot(1, 2, 2)
+    top = terms[:15]
+    rows = np.arange(len(top))
+    ax_bar.barh(rows, [count for _, count in top], color='#F8A978')
+    ax_bar.set_yticks(rows)
+    ax_bar.set_yticklabels([term for term, _ in top], fontsize=11, fontproperties=KOREAN_FONT)
+    ax_bar.invert_yaxis()
+    ax_bar.set_xlabel('빈도', fontsize=12, fontproperties=KOREAN_FONT)
+    ax_bar.set_title('자주 쓰인 단어', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+    summary = '\n'.join(f"{column}: {', '.join(term for term, _ in column_terms[column][:5]) or '-'}"
+                        for column in column_terms)
+    ax_bar.text(0, -0.12, summary, transform=ax_bar.transAxes, va='top', fontsize=10, fontproperties=KOREAN_FONT)
+    
+    draw_word_cloud(ax_cloud, terms)
+    ax_cloud.set_title('단어 구름', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
 
-def create_visualization(df, chart_type, student_name=None):
-    """지정된 차트 유형에 따라 시각화를 생성하고 base64로 인코딩된 이미지를 반환합니다."""
+def draw_likert_distribution(fig, distribution):
+    """문항별 응답 분포를 왼쪽에는 중립(3점) 기준 누적 발산 막대로, 오른쪽에는 점수별 응답 수 표로 그립니다."""
+    counts = distribution.to_numpy(dtype=float)
+    totals = counts.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shares = np.where(totals > 0, counts / totals * 100, 0.0)
+    
+    ax_bar = fig.add_subplot(1, 2, 1)
+    ax_table = fig.add_subplot(1, 2, 2)
+    colors = sns.color_palette('RdBu', len(distribution.columns))
+    rows = np.arange(len(distribution.index))
+    
+    # 부정 응답(1, 2점)과 중립의 절반은 왼쪽, 나머지는 오른쪽으로 쌓음
+    left = -(shares[:, 0] + shares[:, 1] + shares[:, 2] / 2)
+    for j, score in enumerate(distribution.columns):
+        ax_bar.barh(rows, shares[:, j], left=left, color=colors[j], edgecolor='white', label=f'{score}점')
+        left = left + shares[:, j]
+    ax_bar.axvline(0, color='gray', linewidth=1)
+    ax_bar.set_yticks(rows)
+    ax_bar.set_yticklabels(distribution.index, fontsize=10, fontproperties=KOREAN_FONT)
+    ax_bar.invert_yaxis()
+    ax_bar.set_xlim(-100, 100)
+    ax_bar.set_xlabel('응답 비율 (%)', fontsize=12, fontproperties=KOREAN_FONT)
+    ax_bar.set_title('문항별 응답 분포', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+    ax_bar.legend(ncol=len(distribution.columns), loc='upper center', bbox_to_anchor=(0.5, -0.08),
+                  prop=KOREAN_FONT, fontsize=9)
+    
+    sns.heatmap(distribution, annot=True, fmt='d', cmap='Oranges', cbar=False, ax=ax_table)
+    ax_table.set_title('점수별 응답 수', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+    ax_table.set_xlabel('점수', fontsize=12, fontproperties=KOREAN_FONT)
+    ax_table.set_yticklabels(ax_table.get_yticklabels(), rotation=0, fontsize=10, fontproperties=KOREAN_FONT)
+
+def create_visualization(df, chart_type, student_name=None, aggregates=None, missing_as_zero=False,
+                         bootstrap_resamples=BOOTSTRAP_RESAMPLES, n_profiles=PROFILE_CLUSTERS):
+    """지정된 차트 유형에 따라 시각화를 생성하고 base64로 인코딩된 이미지를 반환합니다.
+
+    aggregates(SurveyAggregates)가 주어지면 반 전체 통계는 원본 행 대신 누적 집계에서 읽습니다.
+    반 전체 통계는 무응답을 건너뛰며, missing_as_zero이면 이전 방식대로 무응답을 0점으로 계산합니다.
+    평균 차트의 오차 막대는 bootstrap_resamples회 재표집한 95% 신뢰구간이며, 0이면 표준편차를 씁니다.
+    학생 프로필 군집은 n_profiles개로 나눕니다.
+    """
     if df is None:
         return None, "데이터를 찾을 수 없습니다."
     
@@ -304,144 +2236,274 @@ def create_visualization(df, chart_type, student_name=None):
     if missing_columns:
         return None, f"다음 컬럼을 찾을 수 없습니다: {', '.join(missing_columns)}\n현재 데이터프레임 컬럼: {', '.join(df.columns)}"
     
-    # 그래프 초기화
-    plt.clf()
-    plt.close('all')
-    
-    # 그래프 생성
-    fig = plt.figure(figsize=(12, 8), dpi=100)
-    
+    # 그래프 생성 (pyplot 전역 상태 없이 이 호출만의 Figure에 그림)
+    fig = new_figure(figsize=(12, 8), dpi=100)
+
     try:
         if chart_type == '학생별 설문 응답':
             if student_name is None:
                 return None, "학생 이름을 지정해주세요."
-            
+        
             student_data = df[df['학생 이름'] == student_name]
             if student_data.empty:
                 return None, f"'{student_name}' 학생을 찾을 수 없습니다."
-            
+        
             survey_items = ['수업 기대도', '긴장도', '재미 예상도', '자신감', '집중도', 
                         '즐거움', '자신감 변화', '재미 변화', '긴장도 변화', '이해도']
-            
+        
             # 결측값 처리
             values = student_data[survey_items].iloc[0].fillna(0)
-            
+        
             ax = fig.add_subplot(111)
             bars = ax.bar(range(len(survey_items)), values)
-            
+        
             # 한글 폰트 적용
             ax.set_title(f'{student_name} 학생의 설문 응답', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
             ax.set_xticks(range(len(survey_items)))
             ax.set_xticklabels(survey_items, rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
             ax.set_ylabel('점수 (1-5)', fontsize=12, fontproperties=KOREAN_FONT)
             ax.set_ylim(0, 5)
-            
+        
             # 막대 위에 값 표시
             for bar in bars:
                 height = bar.get_height()
                 ax.text(bar.get_x() + bar.get_width()/2., height,
                     f'{height:.1f}',
                     ha='center', va='bottom', fontproperties=KOREAN_FONT)
-            
+        
             # 자기 평가 정보 추가
             if '수업 요약' in student_data.columns and '자기 평가' in student_data.columns:
                 evaluation_text = f"\n수업 요약: {student_data['수업 요약'].iloc[0]}\n"
                 evaluation_text += f"자기 평가: {student_data['자기 평가'].iloc[0]}"
-                plt.figtext(0.02, 0.02, evaluation_text, fontsize=10, wrap=True, fontproperties=KOREAN_FONT)
-        
+                fig.text(0.02, 0.02, evaluation_text, fontsize=10, wrap=True, fontproperties=KOREAN_FONT)
+    
         elif chart_type == '문항별 평균 점수':
             survey_items = ['수업 기대도', '긴장도', '재미 예상도', '자신감', '집중도', 
                         '즐거움', '자신감 변화', '재미 변화', '긴장도 변화', '이해도']
-            
-            # 결측값 처리
-            means = df[survey_items].fillna(0).mean()
-            stds = df[survey_items].fillna(0).std()
-            
+        
+            # 결측값 처리: 무응답은 건너뜀 (missing_as_zero이면 이전 방식대로 0점, 누적 집계가 있으면 O(문항) 조회)
+            if aggregates is not None:
+                means = aggregates.item_means()
+                stds = aggregates.item_stds()
+                counts = aggregates.item_counts()
+            else:
+                items_df = df[survey_items].fillna(0) if missing_as_zero else df[survey_items]
+                means = items_df.mean()
+                stds = items_df.std()
+                counts = items_df.count()
+        
+            # 오차 막대: 학생 수가 적은 반에서도 의미 있는 부트스트랩 신뢰구간, 행이 많으면 정규 근사 (0회이면 이전처럼 표준편차)
+            # 누적 집계가 있으면 데이터 버전마다 한 번만 계산
+            if bootstrap_resamples > 0:
+                if aggregates is not None:
+                    lower, upper, error_label = aggregates.mean_ci(df, bootstrap_resamples)
+                else:
+                    lower, upper, error_label = items_mean_ci(df, means, stds, counts, bootstrap_resamples, missing_as_zero)
+                mean_values = np.asarray(means, dtype=float)
+                yerr = np.vstack([mean_values - lower, upper - mean_values]).clip(min=0)
+            else:
+                yerr = stds
+                error_label = '표준편차'
+        
             ax = fig.add_subplot(111)
-            bars = ax.bar(range(len(survey_items)), means, yerr=stds, capsize=5)
-            
-            ax.set_title('문항별 평균 점수 (오차 막대: 표준편차)', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+            bars = ax.bar(range(len(survey_items)), means, yerr=yerr, capsize=5)
+        
+            ax.set_title(f'문항별 평균 점수 (오차 막대: {error_label})', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
             ax.set_xticks(range(len(survey_items)))
-            ax.set_xticklabels(survey_items, rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
+            ax.set_xticklabels([f'{item}\n(n={int(count)})' for item, count in zip(survey_items, counts)],
+                               rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
             ax.set_ylabel('평균 점수 (1-5)', fontsize=12, fontproperties=KOREAN_FONT)
             ax.set_ylim(0, 5)
-            
-            # 막대 위에 값 표시
+        
+            # 막대 위에 값 표시 (응답이 없는 문항은 생략)
             for bar in bars:
                 height = bar.get_height()
+                if np.isnan(height):
+                    continue
                 ax.text(bar.get_x() + bar.get_width()/2., height,
                     f'{height:.2f}',
                     ha='center', va='bottom', fontproperties=KOREAN_FONT)
-        
+    
         elif chart_type == '학생별 변화 추이':
             if student_name is None:
                 return None, "학생 이름을 지정해주세요."
-            
+        
             student_data = df[df['학생 이름'] == student_name]
             if student_data.empty:
                 return None, f"'{student_name}' 학생을 찾을 수 없습니다."
-            
+        
             changes = ['자신감 변화', '재미 변화', '긴장도 변화']
             # 결측값 처리
             values = student_data[changes].iloc[0].fillna(0)
-            
+        
             ax = fig.add_subplot(111)
             bars = ax.bar(range(len(changes)), values)
-            
+        
             ax.set_title(f'{student_name} 학생의 수업 전후 변화', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
             ax.set_xticks(range(len(changes)))
             ax.set_xticklabels(changes, rotation=45, ha='right', fontsize=12, fontproperties=KOREAN_FONT)
             ax.set_ylabel('변화 점수 (1-5)', fontsize=12, fontproperties=KOREAN_FONT)
             ax.set_ylim(0, 5)
-            
+        
             # 막대 위에 값 표시
             for bar in bars:
                 height = bar.get_height()
                 ax.text(bar.get_x() + bar.get_width()/2., height,
                     f'{height:.1f}',
                     ha='center', va='bottom', fontproperties=KOREAN_FONT)
-        
+    
         elif chart_type == '문항별 상관관계':
             survey_items = ['수업 기대도', '긴장도', '재미 예상도', '자신감', '집중도', 
                         '즐거움', '자신감 변화', '재미 변화', '긴장도 변화', '이해도']
-            
-            # 결측값 처리
-            correlation_matrix = df[survey_items].fillna(0).corr()
+        
+            # 결측값 처리 (누적 집계가 있으면 O(문항²) 조회)
+            if aggregates is not None:
+                correlation_matrix = aggregates.item_corr()
+            elif missing_as_zero:
+                correlation_matrix = df[survey_items].fillna(0).corr()
+            else:
+                # 두 문항에 모두 응답한 행만 사용 (pairwise-complete)
+                correlation_matrix = df[survey_items].corr()
             ax = fig.add_subplot(111)
             sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm', center=0, fmt='.2f', ax=ax)
-            
+        
             ax.set_title('문항별 상관관계', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
             ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
             ax.set_yticklabels(ax.get_yticklabels(), fontsize=10, fontproperties=KOREAN_FONT)
-        
+    
+        elif chart_type == '수업 전후 효과 분석':
+            draw_lesson_effects(fig, lesson_effects(df)['class'])
+    
+        elif chart_type == '문항별 응답 분포':
+            # 점수별 응답 수 (누적 집계가 있으면 그대로 읽고, 없으면 bincount 한 번으로 계산)
+            if aggregates is not None:
+                distribution = aggregates.item_distribution()
+            else:
+                distribution = pd.DataFrame(likert_counts(item_matrix(df)), index=NUMERIC_COLUMNS, columns=LIKERT_SCORES)
+            draw_likert_distribution(fig, distribution)
+    
+        elif chart_type == '척도 신뢰도 분석':
+            # 공분산 행렬 하나에서 모든 척도를 계산 (누적 집계가 없으면 이번 데이터로 한 번 누적)
+            if aggregates is not None:
+                scales, items = aggregates.reliability()
+            else:
+                scales, items = scale_reliability(stream_moments([df], missing_as_zero=missing_as_zero))
+            draw_scale_reliability(fig, scales, items)
+    
+        elif chart_type == '자유 응답 분석':
+            # 응답 단위로 캐시된 토큰화 결과를 합친 단어 빈도 (누적 집계가 있으면 그대로 읽음)
+            if aggregates is not None:
+                terms = aggregates.top_terms()
+                column_terms = {column: aggregates.top_terms(column=column) for column in TEXT_COLUMNS}
+            else:
+                column_terms = {column: response_terms(df[column]).most_common(TOP_TERMS)
+                                for column in TEXT_COLUMNS if column in df.columns}
+                terms = sum((Counter(dict(pairs)) for pairs in column_terms.values()), Counter()).most_common(TOP_TERMS)
+            if not terms:
+                return None, "분석할 자유 응답이 없습니다."
+            draw_text_analytics(fig, terms, column_terms)
+    
+        elif chart_type == '학생 프로필 군집':
+            # 학생별 평균 벡터 (누적 집계가 있으면 학생별 누적기에서 읽고, 배정 결과는 데이터 버전별로 재사용)
+            if aggregates is None:
+                aggregates = SurveyAggregates('전체', missing_as_zero)
+                aggregates.ingest(df)
+            centers, members = aggregates.student_profiles(n_profiles)
+            if centers.empty:
+                return None, "프로필을 나눌 학생 응답이 없습니다."
+            draw_student_profiles(fig, centers, members)
+    
         # 여백 조정
-        plt.tight_layout(pad=3.0)
-        
+        fig.tight_layout(pad=3.0)
+    
         # 그래프를 base64로 인코딩
-        buf = BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', dpi=300, facecolor='white')
-        buf.seek(0)
-        img_str = base64.b64encode(buf.getvalue()).decode()
-        plt.close()
-        
-        return img_str, None
+        return figure_to_base64(fig), None
     except Exception as e:
         return None, f"시각화 생성 중 오류가 발생했습니다: {str(e)}"
 
-def analyze_survey_data(spreadsheet_id, range_name, chart_type, student_name=None):
+# 학생별 응답 지문과 차트 캐시
+def _fingerprint_rows(header, row_hashes):
+    """컬럼 구성과 행 해시로 내용 지문을 만듭니다."""
+    return hashlib.blake2b(header + row_hashes.tobytes(), digest_size=16).hexdigest()
+
+def _header_bytes(df):
+    return '\x1f'.join(map(str, df.columns)).encode('utf-8')
+
+def student_fingerprints(df):
+    """학생별 응답 행 전체에 대한 내용 지문을 한 번에 계산합니다."""
+    if df is None or df.empty or '학생 이름' not in df.columns:
+        return {}
+    header = _header_bytes(df)
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return {
+        name: _fingerprint_rows(header, row_hashes[positions])
+        for name, positions in df.groupby('학생 이름', sort=False).indices.items()
+    }
+
+def student_fingerprint(df, student_name):
+    """학생 한 명의 응답 행에 대한 내용 지문을 계산합니다. 학생이 없으면 None을 반환합니다."""
+    if df is None or '학생 이름' not in df.columns:
+        return None
+    rows = df[df['학생 이름'] == student_name]
+    if rows.empty:
+        return None
+    return _fingerprint_rows(_header_bytes(df), pd.util.hash_pandas_object(rows, index=False).to_numpy())
+
+def get_student_chart(df, chart_type, student_name, fingerprint=None):
+    """학생 차트를 캐시에서 가져오고, 응답 지문이 바뀐 경우에만 다시 렌더링합니다."""
+    if fingerprint is None:
+        fingerprint = student_fingerprint(df, student_name)
+    if fingerprint is None:
+        return create_visualization(df, chart_type, student_name)
+
+    key = ('chart', chart_type, student_name, fingerprint)
+    img_str = CHART_CACHE.get(key)
+    if img_str is not None:
+        return img_str, None
+
+    img_str, error = create_visualization(df, chart_type, student_name)
+    if img_str:
+        CHART_CACHE.put(key, img_str)
+    return img_str, error
+
+def get_class_chart(df, chart_type, version, aggregates=None, missing_as_zero=False,
+                    bootstrap_resamples=BOOTSTRAP_RESAMPLES, n_profiles=PROFILE_CLUSTERS):
+    """반 전체 차트를 데이터셋 버전 기준으로 캐시합니다. 버전이 같으면 다시 그리지 않습니다."""
+    key = ('class', chart_type, version, missing_as_zero, bootstrap_resamples, n_profiles)
+    img_str = CHART_CACHE.get(key)
+    if img_str is not None:
+        return img_str, None
+
+    img_str, error = create_visualization(df, chart_type, aggregates=aggregates, missing_as_zero=missing_as_zero,
+                                          bootstrap_resamples=bootstrap_resamples, n_profiles=n_profiles)
+    if img_str:
+        CHART_CACHE.put(key, img_str)
+    return img_str, error
+
+def analyze_survey_data(spreadsheet_id, range_name, chart_type, student_name=None, missing_as_zero=False,
+                        bootstrap_resamples=BOOTSTRAP_RESAMPLES, n_profiles=PROFILE_CLUSTERS):
     """
     구글 스프레드시트에서 데이터를 가져와서 시각화를 생성합니다.
     """
     try:
-        service = get_google_sheets_service()
-        if service is None:
-            return None, "구글 스프레드시트 서비스를 초기화할 수 없습니다. 인증 정보를 확인해주세요."
-        
-        df = get_sheet_data(service, spreadsheet_id, range_name)
+        df = load_dataset(spreadsheet_id, range_name)
         if df is None:
-            return None, "데이터를 가져오는데 실패했습니다. 스프레드시트 ID와 범위가 올바른지 확인해주세요."
+            return None, "데이터를 가져오는데 실패했습니다. 인증 정보와 스프레드시트 ID, 범위가 올바른지 확인해주세요."
         
-        img_str, error = create_visualization(df, chart_type, student_name)
+        handle = st.session_state.get('dataset')
+        if student_name is not None:
+            # 공유 캐시에 미리 계산된 학생별 지문이 있으면 그대로 사용
+            fingerprint = None
+            if handle is not None and handle.entry.df is df:
+                fingerprint = handle.entry.student_fingerprints().get(student_name)
+            img_str, error = get_student_chart(df, chart_type, student_name, fingerprint)
+        elif handle is not None and handle.entry.df is df:
+            aggregates = AGGREGATES.update(handle.key, handle.entry, missing_as_zero)
+            img_str, error = get_class_chart(df, chart_type, handle.entry.version, aggregates, missing_as_zero,
+                                             bootstrap_resamples, n_profiles)
+        else:
+            img_str, error = create_visualization(df, chart_type, student_name, missing_as_zero=missing_as_zero,
+                                                  bootstrap_resamples=bootstrap_resamples, n_profiles=n_profiles)
         if error:
             return None, error
         
@@ -449,7 +2511,395 @@ def analyze_survey_data(spreadsheet_id, range_name, chart_type, student_name=Non
     except Exception as e:
         return None, f"분석 중 오류가 발생했습니다: {str(e)}"
 
+# 학생용 탭에 함께 표시하는 차트 (표시 순서)
+STUDENT_TAB_CHARTS = ['학생별 설문 응답', '학생별 변화 추이']
+
+def stream_student_charts(df, student_name, chart_types, fingerprint=None):
+    """학생 차트 여러 개를 작업 스레드에서 동시에 렌더링하고, 끝나는 순서대로 (차트 유형, 이미지, 오류)를 내보냅니다.
+
+    작업 스레드는 st.*를 호출하지 않으므로, 화면 표시는 이 제너레이터를 도는 스크립트 스레드에서 합니다.
+    전체 대기 시간은 가장 느린 차트 하나와 비슷합니다.
+    """
+    if fingerprint is None:
+        fingerprint = student_fingerprint(df, student_name)
+    futures = {RENDER_EXECUTOR.submit(get_student_chart, df, chart_type, student_name, fingerprint): chart_type
+               for chart_type in chart_types}
+    for future in as_completed(futures):
+        yield (futures[future],) + _render_result(future)
+
+def _render_result(future):
+    """렌더링 작업의 (이미지, 오류)를 꺼냅니다. 작업이 예외로 끝났으면 오류 메시지로 바꿉니다."""
+    try:
+        return future.result()
+    except Exception as e:
+        return None, f"분석 중 오류가 발생했습니다: {str(e)}"
+
+def render_in_order(tasks):
+    """서로 독립적인 렌더링 작업 [(함수, 인자...)]를 동시에 실행하고 (이미지, 오류)를 표시 순서대로 반환합니다."""
+    futures = [RENDER_EXECUTOR.submit(fn, *args) for fn, *args in tasks]
+    return [_render_result(future) for future in futures]
+
+# 모든 학생 응답 비교
+ALL_STUDENTS_ITEMS = ['수업 기대도', '긴장도', '재미 예상도', '자신감', '집중도',
+                      '즐거움', '자신감 변화', '재미 변화', '긴장도 변화', '이해도']
+
+def render_all_students(df):
+    """모든 학생의 응답을 학생마다 다른 색의 선 그래프 하나로 겹쳐 그립니다."""
+    students = sorted(df['학생 이름'].unique().tolist())
+    fig = new_figure(figsize=(12, 8), dpi=100)
+    try:
+        ax = fig.add_subplot(111)
+        
+        # 각 학생별로 다른 색상 사용
+        colors = mpl.colormaps['tab20'](np.linspace(0, 1, len(students)))
+        
+        for i, student in enumerate(students):
+            student_data = df[df['학생 이름'] == student]
+            values = []
+            for item in ALL_STUDENTS_ITEMS:
+                if item in student_data.columns:
+                    val = student_data[item].iloc[0]
+                    values.append(float(val) if pd.notna(val) else 0)
+                else:
+                    values.append(0)
+            
+            # 각 학생의 데이터를 선 그래프로 표시
+            ax.plot(range(len(ALL_STUDENTS_ITEMS)), values, marker='o',
+                    color=colors[i], label=student, linewidth=2, alpha=0.7)
+        
+        # 차트 설정
+        ax.set_title('모든 학생의 설문 응답 비교', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
+        ax.set_xticks(range(len(ALL_STUDENTS_ITEMS)))
+        ax.set_xticklabels(ALL_STUDENTS_ITEMS, rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
+        ax.set_ylabel('점수 (1-5)', fontsize=12, fontproperties=KOREAN_FONT)
+        ax.set_ylim(0, 5)
+        ax.grid(True, linestyle='--', alpha=0.7)
+        
+        # 범례 추가
+        ax.legend(title='학생 이름', bbox_to_anchor=(1.05, 1), loc='upper left',
+                  prop=KOREAN_FONT, fontsize=9)
+        fig.tight_layout(pad=3.0)
+        
+        return figure_to_base64(fig), None
+    except Exception as e:
+        return None, f"시각화 중 오류가 발생했습니다: {str(e)}"
+
+def get_all_students_chart(df, version):
+    """모든 학생 응답 비교 차트를 데이터셋 버전 기준으로 캐시합니다."""
+    key = ('all_students', version)
+    img_str = CHART_CACHE.get(key)
+    if img_str is not None:
+        return img_str, None
+    img_str, error = render_all_students(df)
+    if img_str:
+        CHART_CACHE.put(key, img_str)
+    return img_str, error
+
+# 새 데이터가 들어온 뒤 차트 미리 그려 두기
+# 반 전체 차트는 교사용 탭의 기본 설정(무응답 제외, 기본 재표집 횟수와 프로필 수)으로 그립니다.
+WARM_CLASS_CHARTS = ['문항별 평균 점수', '문항별 상관관계', '문항별 응답 분포', '수업 전후 효과 분석', '척도 신뢰도 분석',
+                     '학생 프로필 군집', '자유 응답 분석']
+WARM_MAX_WORKERS = 2  # 학생들이 직접 요청한 렌더링이 밀리지 않도록 작게 둠
+
+class ChartWarmer:
+    """데이터셋이 새로 들어올 때마다 반 전체 차트와 모든 학생의 차트를 미리 렌더링해 차트 캐시에 넣습니다.
+
+    반 전체 차트를 먼저, 그다음 학생 차트를 순서대로 작업 풀에 넣습니다. 그사이 더 새 버전이 들어오면
+    이전 버전의 남은 작업은 취소하거나 건너뜁니다. 켜 둔 데이터셋에 대해서만 동작합니다.
+    """
+
+    def __init__(self, max_workers=WARM_MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mathdata-warm')
+        self.enabled = set()
+        self._jobs = {}  # 데이터셋 키 -> (버전, [Future])
+        self._lock = threading.Lock()
+
+    def enable(self, key):
+        with self._lock:
+            self.enabled.add(key)
+
+    def disable(self, key):
+        with self._lock:
+            self.enabled.discard(key)
+            _, futures = self._jobs.pop(key, (None, []))
+        for future in futures:
+            future.cancel()
+
+    def schedule(self, key, entry, aggregates):
+        """이 버전의 차트 렌더링을 예약합니다. 꺼져 있거나 같은 버전을 이미 예약했으면 아무것도 하지 않습니다."""
+        with self._lock:
+            if key not in self.enabled:
+                return
+            previous = self._jobs.get(key)
+            if previous is not None and previous[0] == entry.version:
+                return
+            df = entry.df
+            tasks = [(get_class_chart, df, chart_type, entry.version, aggregates) for chart_type in WARM_CLASS_CHARTS]
+            if '학생 이름' in df.columns:
+                tasks.append((get_all_students_chart, df, entry.version))
+            tasks += [(get_student_chart, df, chart_type, name, fingerprint)
+                      for name, fingerprint in entry.student_fingerprints().items()
+                      for chart_type in STUDENT_TAB_CHARTS]
+            futures = [self.executor.submit(self._render, key, entry.version, fn, *args) for fn, *args in tasks]
+            self._jobs[key] = (entry.version, futures)
+        if previous is not None:
+            for future in previous[1]:
+                future.cancel()
+
+    def _render(self, key, version, fn, *args):
+        latest = DATASET_CACHE.get(key)
+        if latest is not None and latest.version != version:
+            return None, None  # 이미 더 새 버전이 들어와 있음
+        return fn(*args)
+
+    def progress(self, key):
+        """(끝난 작업 수, 전체 작업 수)를 반환합니다."""
+        with self._lock:
+            _, futures = self._jobs.get(key, (None, []))
+        return sum(future.done() for future in futures), len(futures)
+
+@st.cache_resource
+def get_chart_warmer():
+    """프로세스 공용 차트 미리 그리기 작업자를 반환합니다."""
+    return ChartWarmer()
+
+CHART_WARMER = get_chart_warmer()
+
+# 전체 학생 보고서 일괄 내려받기
+EXPORT_PAGE_CHARTS = ['학생별 설문 응답', '학생별 변화 추이']
+EXPORT_FORMATS = {
+    'ZIP': ('.zip', 'application/zip'),
+    'PDF': ('.pdf', 'application/pdf'),
+}
+
+def _safe_filename(name):
+    """파일 이름에 사용할 수 없는 문자를 밑줄로 바꿉니다."""
+    return ''.join('_' if c in '\\/:*?"<>|' else c for c in str(name)).strip() or 'student'
+
+def build_student_page(df, student_name, as_png=True, fingerprint=None):
+    """학생 한 명의 차트를 A4 한 페이지로 묶습니다. as_png가 참이면 PNG 바이트를, 아니면 Figure를 반환합니다."""
+    fig = new_figure(figsize=(8.27, 11.69), dpi=100)
+    fig.suptitle(f'{student_name} 학생 설문 보고서', fontsize=18, fontweight='bold', fontproperties=KOREAN_FONT)
+
+    for i, chart_type in enumerate(EXPORT_PAGE_CHARTS):
+        img_str, error = get_student_chart(df, chart_type, student_name, fingerprint)
+        ax = fig.add_subplot(len(EXPORT_PAGE_CHARTS), 1, i + 1)
+        ax.axis('off')
+        if img_str:
+            ax.imshow(mpimg.imread(BytesIO(base64.b64decode(img_str)), format='png'))
+        else:
+            ax.text(0.5, 0.5, error, ha='center', va='center', wrap=True, fontproperties=KOREAN_FONT)
+
+    fig.tight_layout(rect=(0, 0, 1, 0.96))
+    if not as_png:
+        return fig
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=150, facecolor='white')
+    page = buf.getvalue()
+    if fingerprint is not None:
+        CHART_CACHE.put(('page', student_name, fingerprint), page)
+    return page
+
+def _remove_file(path):
+    """임시 파일이 남아 있으면 지웁니다."""
+    if os.path.exists(path):
+        os.remove(path)
+
+class BulkExportJob:
+    """학생별 보고서 페이지를 백그라운드에서 렌더링하여 하나의 ZIP 또는 PDF 파일로 기록하는 작업입니다.
+
+    페이지는 작업 풀에서 병렬로 렌더링되고, 학생 순서대로 임시 파일에 바로 기록됩니다.
+    동시에 메모리에 올라가는 페이지는 window 개수로 제한됩니다.
+    응답 지문이 지난번과 같은 학생은 캐시된 차트와 페이지를 그대로 재사용합니다.
+    완성된 파일은 세션에 보관하지 않고 내려받기 버튼을 그릴 때만 읽으며,
+    임시 파일은 새 작업으로 바꾸거나 작업을 취소하거나 세션이 끝나 작업이 사라질 때 지웁니다.
+    """
+
+    def __init__(self, df, students, export_format, executor, window=8, fingerprints=None):
+        self.export_format = export_format
+        self.students = list(students)
+        self.fingerprints = fingerprints if fingerprints is not None else student_fingerprints(df)
+        self.total = len(self.students)
+        self.completed = 0
+        self.reused = 0
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+        suffix, self.mime = EXPORT_FORMATS[export_format]
+        tmp = tempfile.NamedTemporaryFile(prefix='mathdata_export_', suffix=suffix, delete=False)
+        tmp.close()
+        self.path = tmp.name
+        self.file_name = f"학생별_설문_보고서{suffix}"
+        self._cleanup = weakref.finalize(self, _remove_file, self.path)
+
+        self._thread = threading.Thread(target=self._run, args=(df, executor, window), daemon=True)
+        self._thread.start()
+
+    def _submit_page(self, df, executor, student, as_png):
+        """캐시에 없는 학생만 렌더링 작업으로 보냅니다."""
+        fingerprint = self.fingerprints.get(student)
+        if fingerprint is not None:
+            chart_keys = [('chart', chart_type, student, fingerprint) for chart_type in EXPORT_PAGE_CHARTS]
+            page = CHART_CACHE.get(('page', student, fingerprint)) if as_png else None
+            if page is not None or (not as_png and all(key in CHART_CACHE for key in chart_keys)):
+                self.reused += 1
+            if page is not None:
+                future = Future()
+                future.set_result(page)
+                return future
+        return executor.submit(build_student_page, df, student, as_png, fingerprint)
+
+    def _iter_pages(self, df, executor, window, as_png):
+        """렌더링이 끝난 페이지를 학생 순서대로 내보냅니다."""
+        pending = deque()
+        for student in self.students:
+            pending.append((student, self._submit_page(df, executor, student, as_png)))
+            if len(pending) >= window:
+                student_done, future = pending.popleft()
+                yield student_done, future.result()
+        while pending:
+            student_done, future = pending.popleft()
+            yield student_done, future.result()
+
+    def _run(self, df, executor, window):
+        try:
+            if self.export_format == 'ZIP':
+                with zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_STORED) as archive:
+                    for student, page in self._iter_pages(df, executor, window, as_png=True):
+                        if self.cancelled:
+                            break
+                        archive.writestr(f"{self.completed + 1:03d}_{_safe_filename(student)}.png", page)
+                        self.completed += 1
+            else:
+                with PdfPages(self.path) as pdf:
+                    for student, page in self._iter_pages(df, executor, window, as_png=False):
+                        if self.cancelled:
+                            break
+                        pdf.savefig(page)
+                        self.completed += 1
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        """작업을 중단하고 임시 파일을 정리합니다."""
+        self.cancelled = True
+        self.done.wait()
+        self._cleanup()
+
+    def result(self):
+        """완성된 파일 내용을 읽어 돌려줍니다. (보관하지 않으므로 내려받기 버튼을 그릴 때만 호출)"""
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+def start_bulk_export(df, export_format):
+    """세션의 이전 내보내기 작업을 정리하고 새 작업을 시작합니다."""
+    previous = st.session_state.pop('export_job', None)
+    if previous is not None:
+        previous.cancel()
+
+    students = sorted(df['학생 이름'].dropna().unique().tolist())
+    handle = st.session_state.get('dataset')
+    fingerprints = handle.entry.student_fingerprints() if handle is not None and handle.entry.df is df else None
+    job = BulkExportJob(df, students, export_format, get_background_executor(), fingerprints=fingerprints)
+    st.session_state['export_job'] = job
+    return job
+
+EXPORT_PROGRESS_SECONDS = 1
+
+def render_export_progress(job):
+    """내보내기 진행 상황을 한 번 그립니다. 작업이 끝나면 페이지를 다시 실행해 내려받기 버튼을 보여줍니다."""
+    if job.done.is_set():
+        st.rerun()
+    st.progress(job.completed / max(job.total, 1), text=f'보고서를 만드는 중... ({job.completed}/{job.total})')
+
+def show_bulk_export(job, container):
+    """내보내기 진행 상황을 표시하고, 완료되면 내려받기 버튼을 보여줍니다.
+
+    진행 중에는 진행 막대만 주기적으로 갱신하므로 스크립트가 작업을 기다리며 멈추지 않습니다.
+    """
+    with container:
+        if not job.done.is_set():
+            fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+            if fragment is not None:
+                fragment(run_every=EXPORT_PROGRESS_SECONDS)(render_export_progress)(job)
+            else:
+                # 부분 재실행을 지원하지 않는 Streamlit 버전에서는 버튼으로 진행 상황을 다시 확인
+                st.progress(job.completed / max(job.total, 1), text=f'보고서를 만드는 중... ({job.completed}/{job.total})')
+                st.button('🔄 진행 상황 확인', key='export_progress')
+            return
+
+        if job.error:
+            st.error(f"보고서 생성 중 오류가 발생했습니다: {job.error}")
+            return
+
+        st.progress(1.0, text=f'{job.total}명의 보고서가 준비되었습니다. ✅ '
+                              f'(새로 생성 {job.total - job.reused}명, 재사용 {job.reused}명)')
+        st.download_button(f'⬇️ {job.export_format} 내려받기', data=job.result(), file_name=job.file_name,
+                           mime=job.mime, use_container_width=True)
+
+# 실시간 교사 대시보드
+LIVE_CHART_OPTIONS = ['문항별 평균 점수', '문항별 상관관계', '문항별 응답 분포']
+
+def render_live_chart(dataset_key, chart_type, missing_as_zero=False, bootstrap_resamples=BOOTSTRAP_RESAMPLES,
+                      touch=True):
+    """공유 캐시의 최신 데이터로 실시간 차트를 그립니다. 데이터 버전이 같으면 캐시된 이미지를 그대로 씁니다.
+
+    touch가 참이면 데이터셋 사용 시각을 갱신해 폴러가 멈추지 않게 합니다.
+    """
+    entry = DATASET_CACHE.get(dataset_key)
+    if entry is None:
+        st.info("데이터를 기다리는 중입니다...")
+        return
+    if touch:
+        entry.last_access = time.time()
+    
+    aggregates = AGGREGATES.update(dataset_key, entry, missing_as_zero)
+    img_str, error = get_class_chart(entry.df, chart_type, entry.version, aggregates, missing_as_zero,
+                                     bootstrap_resamples)
+    if img_str:
+        st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+        updated_at = time.strftime('%H:%M:%S', time.localtime(entry.fetched_at))
+        st.caption(f"📡 응답 {len(entry.df)}개 · 마지막 확인 {updated_at}")
+    else:
+        st.error(error)
+
+def show_live_dashboard(dataset_key, chart_type, interval, container, missing_as_zero=False,
+                        bootstrap_resamples=BOOTSTRAP_RESAMPLES):
+    """차트 컨테이너만 interval초마다 갱신합니다. 페이지 전체는 다시 실행하지 않습니다."""
+    fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+    if fragment is not None:
+        with container:
+            fragment(run_every=interval)(render_live_chart)(dataset_key, chart_type, missing_as_zero, bootstrap_resamples)
+        return
+    
+    # 부분 재실행을 지원하지 않는 Streamlit 버전에서는 컨테이너 하나만 다시 그리는 루프로 대신함
+    # Streamlit은 화면 요소를 보낼 때만 rerun/stop 요청을 확인하므로, 매 주기 확인 시각을 다시 써서
+    # 위젯 조작이나 세션 종료 시 이 루프가 중단되게 함
+    with container:
+        placeholder = st.empty()
+        heartbeat = st.empty()
+    shown_version = object()
+    # 루프는 사용 시각을 갱신하지 않으며, 조작 없이 폴러의 유휴 시간이 지나면 스스로 멈춤
+    deadline = time.time() + POLL_IDLE_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        entry = DATASET_CACHE.get(dataset_key)
+        version = entry.version if entry is not None else None
+        if version != shown_version:
+            with placeholder.container():
+                render_live_chart(dataset_key, chart_type, missing_as_zero, bootstrap_resamples, touch=False)
+            shown_version = version
+        heartbeat.caption(f"🔄 실시간 확인 중 · {time.strftime('%H:%M:%S')}")
+        time.sleep(interval)
+    heartbeat.info("오랫동안 조작이 없어 실시간 갱신을 멈췄습니다. 페이지를 다시 실행하면 이어서 갱신합니다.")
+
 def main():
+    # 이번 실행에서 데이터셋을 한 번만 조회하도록 실행 번호 갱신
+    begin_run()
+    
     # 커스텀 CSS 스타일 추가
     st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
     
@@ -484,141 +2934,367 @@ def main():
     st.sidebar.header('📋 스프레드시트 설정')
     spreadsheet_id = st.sidebar.text_input('📝 스프레드시트 ID를 입력하세요')
     range_name = st.sidebar.text_input('📍 데이터 범위를 입력하세요 (예: Sheet1!A1:F100)')
+    export_job = None
+    live_dashboard = None
     
-    # 학생 데이터 분석 (학생용 탭)
+    force_refresh = False
+    if spreadsheet_id and range_name:
+        force_refresh = st.sidebar.button('🔄 최신 데이터 불러오기', use_container_width=True)
+        if not force_refresh:
+            # 조회는 백그라운드에서 먼저 시작하고, 그동안 나머지 사이드바를 그림
+            prefetch_dataset(spreadsheet_id, range_name)
+        
+        # 수업 중 백그라운드에서 데이터를 계속 최신으로 유지
+        with st.sidebar.expander("⏱️ 실시간 자동 새로고침", expanded=False):
+            dataset_key = make_dataset_key(spreadsheet_id, range_name)
+            live_refresh = st.checkbox('백그라운드에서 주기적으로 새로고침', key='live_refresh')
+            poll_interval = st.slider('새로고침 간격 (초)', min_value=5, max_value=300,
+                                      value=POLL_INTERVAL_SECONDS, step=5, key='poll_interval')
+            token = (session_token(), 'sidebar')
+            previous_key = st.session_state.get('poller_key')
+            if previous_key is not None and (not live_refresh or previous_key != dataset_key):
+                # 이 세션의 구독만 풀고, 다른 세션이 쓰는 폴러는 계속 돌게 둠
+                POLLERS.release(previous_key, token)
+                st.session_state.pop('poller_key')
+            if live_refresh:
+                service = get_google_sheets_service()
+                poller = POLLERS.subscribe(dataset_key, token, service, poll_interval) if service is not None else None
+                if poller is not None:
+                    st.session_state['poller_key'] = dataset_key
+                    if poller.interval < poll_interval:
+                        st.caption(f"다른 화면이 더 짧은 간격을 쓰고 있어 {poller.interval:g}초마다 새로고침합니다.")
+                    if poller.last_error:
+                        st.warning(f"새로고침 실패 {poller.failures}회, 잠시 후 다시 시도합니다: {poller.last_error}")
+        
+        # 차트 미리 그리기 설정과 데이터 기준 시각은 데이터를 불러온 뒤 이 자리에 표시
+        warm_charts = st.sidebar.checkbox('🖼️ 새 데이터의 차트 미리 그려 두기', key='warm_charts',
+                                          help='반 전체 차트를 먼저, 그다음 모든 학생의 차트를 미리 그려 클릭하면 바로 보이게 합니다.')
+        data_status = st.sidebar.container()
+    
+    # 여러 반 등록 (반별 비교용)
+    with st.sidebar.expander("🏫 여러 반 비교", expanded=False):
+        class_registry = st.text_area('한 줄에 한 반씩: 반 이름, 스프레드시트 ID, 범위', key='class_registry',
+                                      placeholder='1반, 1AbC..., Sheet1!A1:O100\n2반, 1XyZ..., Sheet1!A1:O100')
+        classes = parse_class_registry(class_registry)
+        if classes:
+            st.caption(f"등록된 반 {len(classes)}개 · 교사용 탭의 '반별 비교'에서 함께 분석합니다.")
+    
+    # 탭 제목을 먼저 그려 두고, 그다음 (미리 시작한) 데이터셋 조회를 기다림
     with tab1:
         st.header("🧩 내 설문 데이터 확인하기")
+    with tab2:
+        st.header("📊 전체 학생 설문 분석")
+    
+    # 이번 실행에서 두 탭이 함께 쓸 데이터셋을 한 번만 불러옴 (새로고침 버튼은 공유 캐시를 건너뜀)
+    if spreadsheet_id and range_name:
+        load_dataset(spreadsheet_id, range_name, force=force_refresh)
+        handle = st.session_state.get('dataset')
         
+        # 새 데이터가 들어올 때마다 모든 차트를 백그라운드에서 미리 그려 둠
+        dataset_key = make_dataset_key(spreadsheet_id, range_name)
+        if warm_charts:
+            previous_key = st.session_state.get('warm_key')
+            if previous_key is not None and previous_key != dataset_key:
+                CHART_WARMER.disable(previous_key)
+            CHART_WARMER.enable(dataset_key)
+            st.session_state['warm_key'] = dataset_key
+            if handle is not None and handle.key == dataset_key:
+                # 켜기 전에 들어온 데이터도 바로 미리 그림 (같은 버전은 한 번만 예약됨)
+                CHART_WARMER.schedule(dataset_key, handle.entry, AGGREGATES.update(dataset_key, handle.entry))
+                done, total = CHART_WARMER.progress(dataset_key)
+                if total:
+                    data_status.caption(f"🖼️ 미리 그린 차트: {done}/{total}")
+        elif st.session_state.get('warm_key') is not None:
+            CHART_WARMER.disable(st.session_state.pop('warm_key'))
+        if handle is not None and handle.key == dataset_key:
+            fetched_at = time.strftime('%H:%M:%S', time.localtime(handle.entry.fetched_at))
+            if handle.stale:
+                data_status.warning(f"⚠️ 최신 데이터를 가져오지 못해 {fetched_at} 기준 데이터를 표시합니다. 잠시 후 자동으로 다시 시도합니다.")
+            else:
+                data_status.caption(f"🕒 데이터 기준 시각: {fetched_at} ({len(handle.entry.df)}행)")
+    
+    # 학생 데이터 분석 (학생용 탭)
+    with tab1:
         if not (spreadsheet_id and range_name):
             st.warning("사이드바에서 스프레드시트 ID와 데이터 범위를 먼저 입력해주세요.")
         else:
             # 학생 이름 입력 (자동완성 기능)
-            service = get_google_sheets_service()
-            if service:
-                try:
-                    df = get_sheet_data(service, spreadsheet_id, range_name)
-                    if df is not None and '학생 이름' in df.columns:
-                        student_options = sorted(df['학생 이름'].unique().tolist())
-                        
-                        col1, col2 = st.columns([3, 1])
-                        with col1:
-                            student_name = st.selectbox('👨‍🎓 내 이름 선택하기', options=[""] + student_options)
-                        with col2:
-                            show_data = st.button('📊 내 데이터 보기', use_container_width=True)
-                        
-                        if student_name and show_data:
-                            # 학생별 설문 응답 차트
-                            with st.spinner('데이터를 분석하는 중...'):
-                                img_str, error = analyze_survey_data(spreadsheet_id, range_name, '학생별 설문 응답', student_name)
-                                if img_str:
-                                    st.success(f'"{student_name}" 학생의 설문 응답 분석이 완료되었습니다!')
-                                    st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
-                                    
-                                    # 변화 추이 차트
-                                    img_str2, error2 = analyze_survey_data(spreadsheet_id, range_name, '학생별 변화 추이', student_name)
-                                    if img_str2:
+            try:
+                df = load_dataset(spreadsheet_id, range_name)
+                if df is not None and '학생 이름' in df.columns:
+                    student_options = sorted(df['학생 이름'].unique().tolist())
+                    
+                    col1, col2 = st.columns([3, 1])
+                    with col1:
+                        student_name = st.selectbox('👨‍🎓 내 이름 선택하기', options=[""] + student_options)
+                    with col2:
+                        show_data = st.button('📊 내 데이터 보기', use_container_width=True)
+                    
+                    if student_name and show_data:
+                        # 두 차트를 동시에 렌더링하고, 먼저 끝난 차트부터 자리에 채워 넣음
+                        handle = st.session_state.get('dataset')
+                        fingerprint = None
+                        if handle is not None and handle.entry.df is df:
+                            fingerprint = handle.entry.student_fingerprints().get(student_name)
+                        status = st.empty()
+                        slots = {chart_type: st.empty() for chart_type in STUDENT_TAB_CHARTS}
+                        with st.spinner('데이터를 분석하는 중...'):
+                            for chart_type, img_str, error in stream_student_charts(df, student_name, STUDENT_TAB_CHARTS,
+                                                                                    fingerprint):
+                                if not img_str:
+                                    slots[chart_type].error(error)
+                                    continue
+                                with slots[chart_type].container():
+                                    if chart_type == '학생별 변화 추이':
                                         st.subheader("📈 수업 전후 변화")
-                                        st.image(f"data:image/png;base64,{img_str2}", use_container_width=True)
-                                else:
-                                    st.error(error)
-                    else:
-                        st.error("데이터를 불러올 수 없거나 '학생 이름' 컬럼이 없습니다.")
-                except Exception as e:
-                    st.error(f"데이터 로딩 중 오류가 발생했습니다: {str(e)}")
+                                    st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+                                if chart_type == '학생별 설문 응답':
+                                    status.success(f'"{student_name}" 학생의 설문 응답 분석이 완료되었습니다!')
+                else:
+                    st.error("데이터를 불러올 수 없거나 '학생 이름' 컬럼이 없습니다.")
+            except Exception as e:
+                st.error(f"데이터 로딩 중 오류가 발생했습니다: {str(e)}")
     
     # 전체 데이터 분석 (교사용 탭)
     with tab2:
-        st.header("📊 전체 학생 설문 분석")
-        
         if not (spreadsheet_id and range_name):
             st.warning("사이드바에서 스프레드시트 ID와 데이터 범위를 먼저 입력해주세요.")
         else:
             # 분석 유형 선택
-            chart_options = ['문항별 평균 점수', '문항별 상관관계', '모든 학생 응답 비교']
+            chart_options = ['문항별 평균 점수', '문항별 상관관계', '문항별 응답 분포', '수업 전후 효과 분석', '척도 신뢰도 분석',
+                             '학생 프로필 군집', '위험 신호 학생 알림', '세션별 추이', '자유 응답 분석', '반별 비교',
+                             '모든 학생 응답 비교']
             chart_type = st.selectbox('📈 분석 유형 선택', chart_options)
+            missing_as_zero = st.checkbox('무응답을 0점으로 계산 (이전 방식 호환)', key='missing_as_zero',
+                                          help='기본적으로 무응답은 통계에서 제외하고, 문항별 응답 수(n)를 함께 표시합니다.')
+            bootstrap_resamples = BOOTSTRAP_RESAMPLES
+            if chart_type in ('문항별 평균 점수', '모든 학생 응답 비교'):
+                error_bar = st.radio('오차 막대', ['95% 부트스트랩 신뢰구간', '표준편차'], horizontal=True, key='error_bar',
+                                     help=f'응답이 {BOOTSTRAP_MAX_ROWS:,}행보다 많으면 부트스트랩 대신 정규 근사 신뢰구간을 씁니다.')
+                if error_bar == '표준편차':
+                    bootstrap_resamples = 0
+                else:
+                    bootstrap_resamples = st.select_slider('재표집 횟수', options=[1_000, 2_000, 5_000, 10_000, 20_000],
+                                                           value=BOOTSTRAP_RESAMPLES, key='bootstrap_resamples')
+            n_profiles = PROFILE_CLUSTERS
+            rescan_sheets = False
+            if chart_type == '세션별 추이':
+                rescan_sheets = st.checkbox('새 날짜 시트 바로 확인', key='rescan_sheets',
+                                            help=f'기본적으로 시트 목록은 {TREND_RESCAN_SECONDS // 60}분마다 한 번만 확인합니다.')
+            if chart_type == '학생 프로필 군집':
+                n_profiles = st.slider('프로필 수', min_value=2, max_value=6, value=PROFILE_CLUSTERS, key='n_profiles')
+            
+            # 실시간 모드: 백그라운드 새로고침 + 차트 영역만 부분 갱신 (프로젝터 화면용)
+            live_mode = st.toggle('📡 실시간 모드 (프로젝터 화면용)', key='live_mode',
+                                  help='새 응답이 들어오면 차트만 자동으로 갱신합니다.')
+            if live_mode and chart_type in LIVE_CHART_OPTIONS:
+                live_interval = st.slider('화면 갱신 간격 (초)', min_value=2, max_value=60, value=5, key='live_interval')
+                dataset_key = make_dataset_key(spreadsheet_id, range_name)
+                live_token = (session_token(), 'live')
+                previous_key = st.session_state.get('live_poller_key')
+                if previous_key is not None and previous_key != dataset_key:
+                    POLLERS.release(previous_key, live_token)
+                    st.session_state.pop('live_poller_key')
+                service = get_google_sheets_service()
+                if service is not None:
+                    POLLERS.subscribe(dataset_key, live_token, service,
+                                      st.session_state.get('poll_interval', POLL_INTERVAL_SECONDS))
+                    st.session_state['live_poller_key'] = dataset_key
+                live_dashboard = (dataset_key, chart_type, live_interval, st.container(), missing_as_zero,
+                                  bootstrap_resamples)
+            elif live_mode:
+                st.info(f"실시간 모드는 {', '.join(LIVE_CHART_OPTIONS)}에서 사용할 수 있습니다.")
+            if not (live_mode and chart_type in LIVE_CHART_OPTIONS) and st.session_state.get('live_poller_key') is not None:
+                # 실시간 모드의 구독만 풀고, 자동 새로고침이나 다른 세션의 구독은 그대로 둠
+                POLLERS.release(st.session_state.pop('live_poller_key'), (session_token(), 'live'))
             
             # 분석 버튼
             if st.button('✨ 분석 실행', use_container_width=True):
                 with st.spinner('데이터를 분석하는 중...'):
                     if chart_type == '모든 학생 응답 비교':
                         # 모든 학생의 데이터를 한 페이지에 표시
-                        service = get_google_sheets_service()
-                        if service:
-                            df = get_sheet_data(service, spreadsheet_id, range_name)
-                            if df is not None and '학생 이름' in df.columns:
-                                students = sorted(df['학생 이름'].unique().tolist())
-                                
-                                # 학생별 응답을 그리드 형태로 표시
-                                st.subheader(f"📋 전체 {len(students)}명의 학생 응답")
-                                
-                                survey_items = ['수업 기대도', '긴장도', '재미 예상도', '자신감', '집중도', 
-                                            '즐거움', '자신감 변화', '재미 변화', '긴장도 변화', '이해도']
-                                
-                                # 모든 학생 데이터를 하나의 큰 차트로 시각화
-                                try:
-                                    fig = plt.figure(figsize=(12, 8), dpi=100)
-                                    ax = fig.add_subplot(111)
-                                    
-                                    # 각 학생별로 다른 색상 사용
-                                    colors = plt.cm.tab20(np.linspace(0, 1, len(students)))
-                                    
-                                    for i, student in enumerate(students):
-                                        student_data = df[df['학생 이름'] == student]
-                                        values = []
-                                        for item in survey_items:
-                                            if item in student_data.columns:
-                                                val = student_data[item].iloc[0]
-                                                values.append(float(val) if pd.notna(val) else 0)
-                                            else:
-                                                values.append(0)
-                                                
-                                        # 각 학생의 데이터를 선 그래프로 표시
-                                        ax.plot(range(len(survey_items)), values, marker='o', 
-                                               color=colors[i], label=student, linewidth=2, alpha=0.7)
-                                    
-                                    # 차트 설정
-                                    ax.set_title('모든 학생의 설문 응답 비교', fontsize=16, fontweight='bold', fontproperties=KOREAN_FONT)
-                                    ax.set_xticks(range(len(survey_items)))
-                                    ax.set_xticklabels(survey_items, rotation=45, ha='right', fontsize=10, fontproperties=KOREAN_FONT)
-                                    ax.set_ylabel('점수 (1-5)', fontsize=12, fontproperties=KOREAN_FONT)
-                                    ax.set_ylim(0, 5)
-                                    ax.grid(True, linestyle='--', alpha=0.7)
-                                    
-                                    # 범례 추가
-                                    ax.legend(title='학생 이름', bbox_to_anchor=(1.05, 1), loc='upper left', 
-                                              prop=KOREAN_FONT, fontsize=9)
-                                    
-                                    # 여백 조정
-                                    plt.tight_layout(pad=3.0)
-                                    
-                                    # 그래프를 base64로 인코딩
-                                    buf = BytesIO()
-                                    plt.savefig(buf, format='png', bbox_inches='tight', dpi=300, facecolor='white')
-                                    buf.seek(0)
-                                    img_str = base64.b64encode(buf.getvalue()).decode()
-                                    plt.close()
-                                    
-                                    # 이미지 표시
+                        df = load_dataset(spreadsheet_id, range_name)
+                        if df is not None and '학생 이름' in df.columns:
+                            students = sorted(df['학생 이름'].unique().tolist())
+                            
+                            # 학생별 응답을 그리드 형태로 표시
+                            st.subheader(f"📋 전체 {len(students)}명의 학생 응답")
+                            
+                            # 비교 차트와 평균 차트를 동시에 렌더링하고 표시 순서대로 보여줌
+                            handle = st.session_state['dataset']
+                            aggregates = AGGREGATES.update(handle.key, handle.entry, missing_as_zero)
+                            (img_str, error), (avg_img_str, avg_error) = render_in_order([
+                                (get_all_students_chart, df, handle.entry.version),
+                                (get_class_chart, df, '문항별 평균 점수', handle.entry.version, aggregates, missing_as_zero,
+                                 bootstrap_resamples),
+                            ])
+                            if img_str:
+                                st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+                            else:
+                                st.error(error)
+                            
+                            # 평균값도 함께 표시
+                            st.subheader("📌 문항별 평균 점수")
+                            if avg_img_str:
+                                st.image(f"data:image/png;base64,{avg_img_str}", use_container_width=True)
+                            else:
+                                st.error(avg_error)
+                        else:
+                            st.error("데이터를 불러올 수 없거나 '학생 이름' 컬럼이 없습니다.")
+                    elif chart_type == '수업 전후 효과 분석':
+                        img_str, error = analyze_survey_data(spreadsheet_id, range_name, chart_type)
+                        if img_str:
+                            st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+                            st.caption(f"'기대 → 즐거움'은 같은 학생의 수업 전후 응답을 짝지어 비교하고, "
+                                       f"변화 문항(자신감·재미 향상, 긴장 완화)은 중립 {NEUTRAL_SCORE}점과 비교합니다.")
+                            # 세션별 / 학생별 표는 데이터 버전별 캐시에서 읽음
+                            df = load_dataset(spreadsheet_id, range_name)
+                            handle = st.session_state['dataset']
+                            effects = cached_lesson_effects(df, handle.entry.version, session_name_from_range(range_name))
+                            session_tab, student_tab = st.tabs(["📅 세션별", "👨‍🎓 학생별"])
+                            with session_tab:
+                                st.dataframe(effects['session'].round(2), use_container_width=True, hide_index=True)
+                            with student_tab:
+                                if 'student' in effects:
+                                    st.dataframe(effects['student'].round(2), use_container_width=True, hide_index=True)
+                        else:
+                            st.error(error)
+                    elif chart_type == '척도 신뢰도 분석':
+                        img_str, error = analyze_survey_data(spreadsheet_id, range_name, chart_type,
+                                                             missing_as_zero=missing_as_zero)
+                        if img_str:
+                            st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+                            # 표는 차트와 같은 누적 공분산에서 계산
+                            handle = st.session_state['dataset']
+                            scales, items = AGGREGATES.update(handle.key, handle.entry, missing_as_zero).reliability()
+                            st.dataframe(scales.round(3), use_container_width=True, hide_index=True)
+                            st.dataframe(items.round(3), use_container_width=True, hide_index=True)
+                            st.caption("α가 0.7 이상이면 대체로 일관된 척도로 봅니다. 문항을 뺐을 때 α가 오르는 문항은 척도와 어울리지 않을 수 있습니다.")
+                        else:
+                            st.error(error)
+                    elif chart_type == '세션별 추이':
+                        # 새 날짜 시트만 한 번씩 가져오고, 추이는 저장된 세션 집계에서 읽음
+                        load_dataset(spreadsheet_id, range_name)
+                        credentials = get_sheets_credentials()
+                        try:
+                            if credentials is not None:
+                                with SHEETS_SERVICES.lease(credentials) as service:
+                                    added, failed = ingest_dated_sheets(service, spreadsheet_id, rescan_sheets)
+                                if added:
+                                    st.info(f"새 날짜 시트 {added}개를 반영했습니다.")
+                                if failed:
+                                    st.warning("다음 시트는 가져오지 못해 다음 확인 때 다시 시도합니다: "
+                                               + ', '.join(f"{title} ({error})" for title, error in failed))
+                        except Exception as e:
+                            st.warning(f"시트 목록을 확인하지 못해 저장된 세션만 표시합니다: {str(e)}")
+                        (img_str, error), trend = get_trend_chart(spreadsheet_id)
+                        if img_str:
+                            st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+                            st.dataframe(trend.round(2), use_container_width=True)
+                        else:
+                            st.error(error)
+                    elif chart_type == '반별 비교':
+                        if len(classes) < 2:
+                            st.warning("사이드바의 '🏫 여러 반 비교'에 두 개 이상의 반을 등록해주세요.")
+                        else:
+                            credentials = get_sheets_credentials()
+                            started = time.perf_counter()
+                            results = load_classes(credentials, classes) if credentials is not None else {}
+                            elapsed = time.perf_counter() - started
+                            datasets = {name: (key, entry) for name, (key, entry, _) in results.items() if entry is not None}
+                            for name, (_, _, error) in results.items():
+                                if error:
+                                    st.warning(f"{name} 데이터를 가져오지 못했습니다: {error}")
+                            if datasets:
+                                img_str, error = get_class_comparison_chart(datasets, missing_as_zero)
+                                if img_str:
                                     st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
-                                    
-                                    # 평균값도 함께 표시
-                                    st.subheader("📌 문항별 평균 점수")
-                                    avg_img_str, _ = analyze_survey_data(spreadsheet_id, range_name, '문항별 평균 점수')
-                                    if avg_img_str:
-                                        st.image(f"data:image/png;base64,{avg_img_str}", use_container_width=True)
-                                    
-                                except Exception as e:
-                                    st.error(f"시각화 중 오류가 발생했습니다: {str(e)}")
+                                    st.caption(f"{len(datasets)}개 반 · {elapsed:.2f}초")
+                                else:
+                                    st.error(error)
+                    elif chart_type == '자유 응답 분석':
+                        img_str, error = analyze_survey_data(spreadsheet_id, range_name, chart_type)
+                        if img_str:
+                            st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+                            # 세션별 상위 단어도 같은 누적 단어 빈도에서 읽음
+                            handle = st.session_state['dataset']
+                            store = AGGREGATES.update(handle.key, handle.entry)
+                            st.dataframe(store.session_top_terms(), use_container_width=True, hide_index=True)
+                        else:
+                            st.error(error)
+                    elif chart_type == '위험 신호 학생 알림':
+                        # 행이 들어올 때마다 갱신해 둔 경고 목록을 그대로 읽음
+                        df = load_dataset(spreadsheet_id, range_name)
+                        if df is not None and '학생 이름' in df.columns:
+                            handle = st.session_state['dataset']
+                            # 무응답을 0점으로 세면 빠뜨린 문항이 급락으로 보이므로 항상 무응답을 제외한 집계에서 읽음
+                            alerts = AGGREGATES.update(handle.key, handle.entry).alert_table()
+                            st.caption(f"최근 {ALERT_WINDOW}개 세션에서 가장 최근 세션이 이전 세션 평균보다 "
+                                       f"{ALERT_THRESHOLD:g}점 이상 나빠진 학생입니다. (긴장도 상승, 이해도·자신감 하락)")
+                            if alerts.empty:
+                                st.success('위험 신호가 보이는 학생이 없습니다.')
                             else:
-                                st.error("데이터를 불러올 수 없거나 '학생 이름' 컬럼이 없습니다.")
+                                st.warning(f"⚠️ {len(alerts)}명의 학생에게 위험 신호가 있습니다.")
+                                st.dataframe(alerts.round(2), use_container_width=True, hide_index=True)
+                        else:
+                            st.error("데이터를 불러올 수 없거나 '학생 이름' 컬럼이 없습니다.")
+                    elif chart_type == '학생 프로필 군집':
+                        img_str, error = analyze_survey_data(spreadsheet_id, range_name, chart_type,
+                                                             missing_as_zero=missing_as_zero, n_profiles=n_profiles)
+                        if img_str:
+                            st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
+                            # 차트와 같은 (데이터 버전별로 저장된) 배정 결과를 표로 표시
+                            handle = st.session_state['dataset']
+                            centers, members = AGGREGATES.update(handle.key, handle.entry, missing_as_zero).student_profiles(n_profiles)
+                            centers_tab, members_tab = st.tabs(["🎯 프로필 중심", "👨‍🎓 학생 배정"])
+                            with centers_tab:
+                                st.dataframe(centers.round(2), use_container_width=True)
+                            with members_tab:
+                                st.dataframe(members.round(2), use_container_width=True, hide_index=True)
+                        else:
+                            st.error(error)
                     else:
                         # 기존 차트 타입 (평균 점수, 상관관계)
-                        img_str, error = analyze_survey_data(spreadsheet_id, range_name, chart_type)
+                        img_str, error = analyze_survey_data(spreadsheet_id, range_name, chart_type,
+                                                             missing_as_zero=missing_as_zero,
+                                                             bootstrap_resamples=bootstrap_resamples)
                         if img_str:
                             st.success('분석이 완료되었습니다!')
                             st.image(f"data:image/png;base64,{img_str}", use_container_width=True)
                         else:
                             st.error(error)
+            
+            # 자유 응답 검색 (역색인에서 바로 찾음)
+            st.divider()
+            st.subheader("🔎 자유 응답 검색")
+            query = st.text_input('검색어 (쉼표는 "또는", 띄어쓰기는 "모두 포함")', placeholder='예: 분수, 일차 방정식',
+                                  key='response_query')
+            if query.strip():
+                df = load_dataset(spreadsheet_id, range_name)
+                if df is not None:
+                    handle = st.session_state['dataset']
+                    store = AGGREGATES.update(handle.key, handle.entry)
+                    started = time.perf_counter()
+                    matches = store.search_responses(query)
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    st.caption(f"응답 {len(matches)}건 · 학생 {matches['학생 이름'].nunique()}명 · {elapsed_ms:.1f}ms")
+                    if not matches.empty:
+                        st.dataframe(matches, use_container_width=True, hide_index=True)
+                else:
+                    st.error("데이터를 불러올 수 없습니다.")
+            
+            # 전체 학생 보고서 일괄 내려받기
+            st.divider()
+            st.subheader("📦 전체 학생 보고서 내려받기")
+            export_format = st.radio('파일 형식', list(EXPORT_FORMATS), horizontal=True)
+            if st.button('📥 전체 보고서 만들기', use_container_width=True):
+                df = load_dataset(spreadsheet_id, range_name)
+                if df is not None and '학생 이름' in df.columns:
+                    start_bulk_export(df, export_format)
+                else:
+                    st.error("데이터를 불러올 수 없거나 '학생 이름' 컬럼이 없습니다.")
+            export_job = st.session_state.get('export_job')
+            export_container = st.container()
     
     # 앱 사용법 안내
     with st.expander("📚 앱 사용 안내", expanded=False):
@@ -642,6 +3318,14 @@ def main():
         </ol>
         </div>
         """, unsafe_allow_html=True)
+    
+    # 보고서 내보내기 진행 상황은 화면을 모두 그린 뒤에 표시
+    if export_job is not None:
+        show_bulk_export(export_job, export_container)
+    
+    # 실시간 차트는 마지막에 시작 (부분 재실행을 지원하지 않는 버전에서는 이 지점에서 계속 갱신)
+    if live_dashboard is not None:
+        show_live_dashboard(*live_dashboard)
 
 if __name__ == '__main__':
     main() 